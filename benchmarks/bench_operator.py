@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Operator scale benchmark.
+
+Runs the real prom_scaler_async daemons, EvaluationScheduler, KubeClient
+(executor, pod metrics cache) and scale_sequence against an in-process
+stand-in for the metrics.k8s.io and monitoring.coreos.com endpoints, with
+configurable object counts, pod counts and injected api latency.
+
+Reports evaluations/sec, p50/p99 evaluation latency, api calls per evaluation,
+operator cpu and max RSS. Thresholds (--max-*) turn it into a regression gate:
+the exit code is 1 when any threshold is exceeded.
+
+Example:
+  python benchmarks/bench_operator.py --objects 500 --pods 4 --namespaces 10 --latency 0.02 --duration 60
+"""
+import argparse
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prometheus_shard_autoscaler'))
+
+import app
+import kube
+from kube import KubeClient, PodMetricsCache, PROM_OPERATOR_LABEL_PREFIX
+from kubernetes.client.rest import ApiException
+from scheduler import EvaluationScheduler
+
+class FakeClusterApi:
+    """ in-process stand-in for CustomObjectsApi serving prometheuses and their pod metrics """
+    def __init__(self, objects:dict, pods:int, latency:float, memoryUtil:float):
+        self.objects = objects # (namespace, name) -> {'spec': ..., 'meta': ..., 'annotations': ...}
+        self.pods = pods
+        self.latency = latency
+        self.memoryUtil = memoryUtil
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, call:str):
+        with self._lock:
+            self.calls[call] += 1
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency) # blocking, like the real client
+
+    def _pod_metrics(self, namespace:str, name:str, spec:dict) -> list:
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        memory = int(5 * 2**30 * self.memoryUtil * random.uniform(0.9, 1.1))
+        return [{
+            'metadata': {
+                'name': f"prometheus-{name}-shard-{shard}-0",
+                'namespace': namespace,
+                'labels': {f"{PROM_OPERATOR_LABEL_PREFIX}/name": name, f"{PROM_OPERATOR_LABEL_PREFIX}/shard": str(shard)}
+            },
+            'timestamp': timestamp,
+            'window': '30s',
+            'containers': [{'name': 'prometheus', 'usage': {'cpu': '250000000n', 'memory': f"{memory // 1024}Ki"}}]
+        } for shard in range(self.pods)]
+
+    def list_namespaced_custom_object(self, namespace:str, label_selector:str=None, **kwargs) -> dict:
+        self._call('list_pod_metrics')
+        items = []
+        for (objNamespace, name), obj in list(self.objects.items()):
+            if objNamespace == namespace and (label_selector is None or label_selector in (f"{PROM_OPERATOR_LABEL_PREFIX}/name", f"{PROM_OPERATOR_LABEL_PREFIX}/name={name}")):
+                items += self._pod_metrics(namespace, name, obj['spec'])
+        return {'items': items}
+
+    def list_cluster_custom_object(self, label_selector:str=None, **kwargs) -> dict:
+        self._call('list_pod_metrics')
+        items = []
+        for (namespace, name), obj in list(self.objects.items()):
+            items += self._pod_metrics(namespace, name, obj['spec'])
+        return {'items': items}
+
+    def patch_namespaced_custom_object(self, namespace:str, name:str, body:dict, **kwargs) -> dict:
+        self._call('patch_prometheus')
+        obj = self.objects[(namespace, name)]
+        resourceVersion = body.get('metadata', {}).get('resourceVersion')
+        if resourceVersion is not None and resourceVersion != obj['meta']['resourceVersion']:
+            raise ApiException(status=409, reason='Conflict')
+        obj['spec'].update(body.get('spec', {}))
+        obj['annotations'].update(body.get('metadata', {}).get('annotations', {}))
+        obj['meta']['resourceVersion'] = str(int(obj['meta']['resourceVersion']) + 1)
+        return {}
+
+class BenchKubeClient(KubeClient):
+    """ KubeClient using the fake cluster api - everything but the transport is the real client """
+    def __init__(self, logger, api:FakeClusterApi, metricsCache:PodMetricsCache, executor, requestTimeout:float):
+        self.clientCustomObjectsApi = api
+        self.metricsCache = metricsCache
+        self.executor = executor
+        self.leaseExecutor = None
+        self.requestTimeout = requestTimeout
+        self.connectTimeout = requestTimeout
+        self.callTimeout = requestTimeout
+        self.metricsMaxAge = 120
+        self.dryRun = False
+        self._podUsage = {}
+        kube.LOGGER = logger
+
+class TimedScheduler(EvaluationScheduler):
+    """ EvaluationScheduler recording the latency of every evaluation """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    async def _evaluate(self, key):
+        start = time.monotonic()
+        try:
+            await super()._evaluate(key)
+        finally:
+            self.latencies.append(time.monotonic() - start)
+
+class Stopped:
+    """ stand-in for kopf's DaemonStopped flag """
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    async def wait(self):
+        await self._event.wait()
+
+    def set(self):
+        self._event.set()
+
+def percentile(values:list, q:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+async def run(args) -> dict:
+    logger = logging.getLogger('bench')
+    objects = {}
+    for i in range(args.objects):
+        namespace = f"ns-{i % args.namespaces}"
+        name = f"prom-{i}"
+        objects[(namespace, name)] = {
+            'spec': {'shards': args.pods, 'resources': {'requests': {'memory': '5Gi', 'cpu': '500m'}}},
+            'meta': {'resourceVersion': '1'},
+            'annotations': {
+                f"{app.PROM_AUTOSCALER_KEY_PREFIX}/enable": 'true',
+                f"{app.PROM_AUTOSCALER_KEY_PREFIX}/evaluation-interval": str(args.interval),
+                f"{app.PROM_AUTOSCALER_KEY_PREFIX}/desired-shards-algorithm": args.algorithm,
+                f"{app.PROM_AUTOSCALER_KEY_PREFIX}/current-usage-calculator": args.calculator,
+                f"{app.PROM_AUTOSCALER_KEY_PREFIX}/max-shards": str(args.pods * 4),
+                f"{app.PROM_AUTOSCALER_KEY_PREFIX}/min-cooldown": str(args.cooldown),
+            }
+        }
+
+    api = FakeClusterApi(objects, args.pods, args.latency, args.memory_util)
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='kube-api')
+    app.LOGGER = logger
+    app.KUBECLIENT = BenchKubeClient(logger, api, PodMetricsCache(scope=args.cache_scope), executor, requestTimeout=10)
+    app.SCHEDULER = scheduler = TimedScheduler(logger, interval=args.interval, maxConcurrency=args.concurrency)
+    schedulerTask = asyncio.ensure_future(scheduler.run())
+
+    stopped = Stopped()
+    daemons = [
+        asyncio.ensure_future(app.prom_scaler_async(
+            spec=obj['spec'], meta=obj['meta'], name=name, namespace=namespace, annotations=obj['annotations'], labels={}, patch={},
+            stopped=stopped
+        )) for (namespace, name), obj in objects.items()
+    ]
+
+    # warm up one interval so every object has been evaluated once before measuring
+    await asyncio.sleep(args.interval)
+    scheduler.latencies.clear(); api.calls.clear()
+    cpuStart = time.process_time(); start = time.monotonic()
+    await asyncio.sleep(args.duration)
+    elapsed = time.monotonic() - start; cpu = time.process_time() - cpuStart
+    latencies = list(scheduler.latencies); calls = dict(api.calls)
+
+    stopped.set()
+    await asyncio.gather(*daemons)
+    schedulerTask.cancel()
+    executor.shutdown(wait=False)
+
+    evaluations = len(latencies)
+    return {
+        'objects': args.objects,
+        'pods': args.pods,
+        'namespaces': args.namespaces,
+        'latency_ms': args.latency * 1000,
+        'evaluations': evaluations,
+        'evaluations_per_sec': round(evaluations / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'api_calls': sum(calls.values()),
+        'api_calls_by_type': calls,
+        'api_calls_per_evaluation': round(sum(calls.values()) / evaluations, 3) if evaluations else 0.0,
+        'cpu_cores': round(cpu / elapsed, 3),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the operator against a fake metrics-server and api server")
+    parser.add_argument('--objects', type=int, default=100, help="annotated Prometheus objects")
+    parser.add_argument('--pods', type=int, default=2, help="pods (shards) per Prometheus")
+    parser.add_argument('--namespaces', type=int, default=10, help="namespaces the objects are spread across")
+    parser.add_argument('--latency', type=float, default=0.01, help="mean injected api latency (seconds)")
+    parser.add_argument('--duration', type=float, default=30, help="measured duration (seconds)")
+    parser.add_argument('--interval', type=int, default=5, help="evaluation-interval (seconds)")
+    parser.add_argument('--workers', type=int, default=app.PROM_AUTOSCALER_API_WORKERS, help="api executor threads")
+    parser.add_argument('--concurrency', type=int, default=app.PROM_AUTOSCALER_MAX_CONCURRENT_EVALUATIONS, help="max in-flight evaluations")
+    parser.add_argument('--cache-scope', default='namespace', choices=('namespace', 'cluster'))
+    parser.add_argument('--algorithm', default='double-or-decrement')
+    parser.add_argument('--calculator', default='avg')
+    parser.add_argument('--cooldown', type=int, default=0, help="min-cooldown (seconds) - 0 evaluates every object every interval")
+    parser.add_argument('--memory-util', type=float, default=0.5, help="pod memory usage relative to requests")
+    parser.add_argument('--max-p99-ms', type=float, default=None, help="fail when p99 evaluation latency exceeds this")
+    parser.add_argument('--max-api-calls-per-evaluation', type=float, default=None, help="fail when api calls per evaluation exceed this")
+    parser.add_argument('--min-evaluations-per-sec', type=float, default=None, help="fail when evaluations/sec falls below this")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key}: {value}")
+
+    failures = []
+    if args.max_p99_ms is not None and report['p99_ms'] > args.max_p99_ms:
+        failures.append(f"p99_ms {report['p99_ms']} > {args.max_p99_ms}")
+    if args.max_api_calls_per_evaluation is not None and report['api_calls_per_evaluation'] > args.max_api_calls_per_evaluation:
+        failures.append(f"api_calls_per_evaluation {report['api_calls_per_evaluation']} > {args.max_api_calls_per_evaluation}")
+    if args.min_evaluations_per_sec is not None and report['evaluations_per_sec'] < args.min_evaluations_per_sec:
+        failures.append(f"evaluations_per_sec {report['evaluations_per_sec']} < {args.min_evaluations_per_sec}")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Quantity parsing benchmark and equivalence check.
+
+Checks that the integer fast path (utils.parse_quantity_int) matches
+ceil(parse_quantity(q) * unit) on randomly generated quantities - valid,
+fractional and invalid - then times both parsers on metrics-server-like
+pod usage values, with and without memoization.
+
+Example:
+  python benchmarks/bench_quantity.py --samples 100000
+"""
+import argparse
+from decimal import localcontext
+from math import ceil
+import random
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prometheus_shard_autoscaler'))
+
+import utils
+
+SUFFIXES = ["", "n", "u", "m", "k", "K", "M", "G", "T", "P", "E", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "ni", "ui", "mi"]
+INVALID_SUFFIXES = ["ki", "i", "x", "Xi", "B", " "]
+UNITS = (1, utils.NANOCORES)
+
+def random_quantity(rng:random.Random) -> str:
+    kind = rng.random()
+    number = str(rng.randrange(0, 10**rng.randint(1, 15)))
+    if kind < 0.15:
+        number = f"{number}.{rng.randrange(0, 1000)}"
+    elif kind < 0.2:
+        number = f"{rng.choice(['-', '+'])}{number}"
+    elif kind < 0.25:
+        number = f"{number}e{rng.randint(-3, 3)}"
+    elif kind < 0.3:
+        number = rng.choice(["", ".", "1.2.3", "abc", "٣"])
+    suffix = rng.choice(INVALID_SUFFIXES) if rng.random() < 0.05 else rng.choice(SUFFIXES)
+    return number + suffix
+
+def reference(quantity:str, unit:int):
+    try:
+        with localcontext() as ctx:
+            ctx.prec = 100 # exact for the generated magnitudes
+            return ceil(utils.parse_quantity(quantity) * unit)
+    except ValueError:
+        return ValueError
+
+def fast(quantity:str, unit:int):
+    try:
+        return utils.parse_quantity_int(quantity, unit)
+    except ValueError:
+        return ValueError
+
+def check_equivalence(samples:int, seed:int) -> int:
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(samples):
+        quantity = random_quantity(rng)
+        for unit in UNITS:
+            expected = reference(quantity, unit); actual = fast(quantity, unit)
+            if expected != actual:
+                mismatches += 1
+                print(f"MISMATCH: {quantity!r} unit={unit}: parse_quantity={expected} parse_quantity_int={actual}", file=sys.stderr)
+    return mismatches
+
+def pod_usage_values(pods:int, seed:int) -> list:
+    # cpu in nanocores and memory in Ki, as reported by metrics-server
+    rng = random.Random(seed)
+    return [(f"{rng.randrange(10**6, 4 * 10**9)}n", f"{rng.randrange(10**5, 10**8)}Ki") for _ in range(pods)]
+
+def time_parsers(pods:int, repeat:int, seed:int) -> dict:
+    values = pod_usage_values(pods, seed)
+
+    def parse_decimal():
+        cpu = 0; memory = 0
+        for podCpu, podMemory in values:
+            cpu += utils.parse_quantity(podCpu); memory += utils.parse_quantity(podMemory)
+
+    def parse_int_uncached():
+        cpu = 0; memory = 0
+        for podCpu, podMemory in values:
+            cpu += utils.parse_quantity_int.__wrapped__(podCpu, utils.NANOCORES); memory += utils.parse_quantity_int.__wrapped__(podMemory, 1)
+
+    def parse_int():
+        cpu = 0; memory = 0
+        for podCpu, podMemory in values:
+            cpu += utils.parse_nanocores(podCpu); memory += utils.parse_bytes(podMemory)
+
+    results = {}
+    for name, parse in (('parse_quantity', parse_decimal), ('parse_quantity_int (uncached)', parse_int_uncached), ('parse_quantity_int', parse_int)):
+        seconds = min(timeit.repeat(parse, number=1, repeat=repeat))
+        results[name] = seconds / (2 * pods) * 1e9 # ns per quantity
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="check and benchmark the integer quantity parser against parse_quantity")
+    parser.add_argument('--samples', type=int, default=100000, help="random quantities checked for equivalence")
+    parser.add_argument('--pods', type=int, default=1000, help="pod usage values parsed per timing run")
+    parser.add_argument('--repeat', type=int, default=20, help="timing runs (the fastest is reported)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mismatches = check_equivalence(args.samples, args.seed)
+    print(f"equivalence: {args.samples} random quantities x {len(UNITS)} units, {mismatches} mismatches")
+    for name, nsPerQuantity in time_parsers(args.pods, args.repeat, args.seed).items():
+        print(f"{name}: {nsPerQuantity:.0f} ns/quantity")
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
 import boto3
+import botocore.config
+import botocore.exceptions
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
 import requests
 import json
 import os
+import threading
+import time
 import yaml
 import shutil
 import logging
@@ -12,11 +19,22 @@ from logging.handlers import RotatingFileHandler
 # extract OS envs
 OBJSTORE_CONFIG = yaml.load(os.environ['OBJSTORE_CONFIG'], Loader=yaml.SafeLoader)
 S3_BUCKET = OBJSTORE_CONFIG['config']['bucket']
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '8')) # files uploaded concurrently
+UPLOAD_PART_CONCURRENCY = int(os.getenv('UPLOAD_PART_CONCURRENCY', '4')) # parts of a multipart file uploaded concurrently
+UPLOAD_PART_SIZE_MB = int(os.getenv('UPLOAD_PART_SIZE_MB', '64')) # multipart threshold and part size
+UPLOAD_BUFFER_MB = int(os.getenv('UPLOAD_BUFFER_MB', '512')) # max part data held in memory across all uploads (at least one part)
+UPLOAD_SKIP_SHIPPED = os.getenv('UPLOAD_SKIP_SHIPPED', 'true').lower() == 'true' # skip blocks already in the bucket (shipped by the thanos sidecar or a previous run)
+UPLOAD_DEADLINE = float(os.getenv('UPLOAD_DEADLINE', '0')) # seconds to finish uploading before giving up on the remaining (oldest) blocks - keep below terminationGracePeriodSeconds (0 disables)
 
 # set constants
-S3_CLIENT = boto3.client('s3')
+S3_CLIENT = boto3.client('s3', config=botocore.config.Config(max_pool_connections=UPLOAD_WORKERS * UPLOAD_PART_CONCURRENCY))
+PART_SIZE = UPLOAD_PART_SIZE_MB * 1024 * 1024
+PART_BUFFERS = threading.BoundedSemaphore(max(UPLOAD_BUFFER_MB // UPLOAD_PART_SIZE_MB, 1)) # parts read but not uploaded yet
+PART_EXECUTOR = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS * UPLOAD_PART_CONCURRENCY)
 PROMETHEUS_DIRECTORY="/prometheus"
 PROMETHEUS_CONF_OUT_YAML="/etc/prometheus/config_out/prometheus.env.yaml"
+THANOS_SHIPPER_FILE=f"{PROMETHEUS_DIRECTORY}/thanos.shipper.json"
+UPLOAD_JOURNAL_FILE=f"{PROMETHEUS_DIRECTORY}/snapshot-upload.journal.json"
 
 def cleanup():
     removeDirs = ['snapshots', 'wal'] # TODO: consider wiping out everything under /prometheus
@@ -53,6 +71,38 @@ def request_tsdb_snapshot(snapshotUrl:str='http://localhost:9090/api/v1/admin/ts
     logging.debug(f"response json:\n {json.dumps(res.json(),indent=4)}")
     return f"{PROMETHEUS_DIRECTORY}/snapshots/{res.json()['data']['name']}"
 
+def shipped_blocks() -> set:
+    # ULIDs of the blocks the thanos sidecar already uploaded
+    try:
+        with open(THANOS_SHIPPER_FILE) as shipperfile:
+            return set(json.load(shipperfile).get('uploaded') or [])
+    except (OSError, ValueError) as e:
+        logging.debug(f"unable to read {THANOS_SHIPPER_FILE}: {e}")
+        return set()
+
+def block_in_bucket(block:str) -> bool:
+    # a block is complete in the bucket once its meta.json is
+    try:
+        S3_CLIENT.head_object(Bucket=S3_BUCKET, Key=f"{block}/meta.json")
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def unshipped_blocks(snapshotDir:str) -> list:
+    # the snapshot hard-links every persisted block - only the head block and blocks not shipped yet need an upload
+    blocks = os.listdir(snapshotDir)
+    if not UPLOAD_SKIP_SHIPPED:
+        return blocks
+    shipped = shipped_blocks()
+    candidates = [block for block in blocks if block not in shipped]
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        inBucket = list(executor.map(block_in_bucket, candidates))
+    unshipped = [block for block, found in zip(candidates, inBucket) if not found]
+    logging.info(f"skipping {len(blocks) - len(unshipped)}/{len(blocks)} blocks already in the bucket")
+    return unshipped
+
 def setup_logger():
     for name in ['boto', 'urllib3', 's3transfer', 'boto3', 'botocore', 'nose']: # disable noisy loggers
         logging.getLogger(name).setLevel(logging.CRITICAL)
@@ -63,63 +113,192 @@ def setup_logger():
         handlers=[RotatingFileHandler(f"{PROMETHEUS_DIRECTORY}/snapshot-uploader.log", maxBytes=500000, backupCount=5)]
     )
 
-def upload_snapshot_blocks(snapshotDir:str):
-    def upload_block(snapshotDir:str, blockDir:str, chunks:list()):
-        logging.debug(f"uploading blockDir: {blockDir}")
-        uploadFiles = [
-            f"{blockDir}/index",
-            f"{blockDir}/meta.json",
-        ]
-        uploadFiles += [f"{blockDir}/chunks/" + chunk for chunk in chunks]
+def read_part(fileobj, sha256) -> bytes:
+    # fixed-size read of the next part, hashed in file order - holds a PART_BUFFERS slot until the caller releases it
+    PART_BUFFERS.acquire()
+    try:
+        data = fileobj.read(PART_SIZE)
+    except BaseException:
+        PART_BUFFERS.release()
+        raise
+    sha256.update(data)
+    return data
 
-        for file in uploadFiles:
-            objKey = file.removeprefix(f"{snapshotDir}/")
-            with open(file, 'rb') as data:
-                S3_CLIENT.upload_fileobj(data, S3_BUCKET, objKey) # NOTE: boto3 doesn't support sync at the moment
-    
-    for block in os.listdir(snapshotDir):
-        blockDir = f"{snapshotDir}/{block}"
+def upload_part(objKey:str, uploadId:str, partNumber:int, data:bytes) -> dict:
+    try:
+        response = S3_CLIENT.upload_part(Bucket=S3_BUCKET, Key=objKey, UploadId=uploadId, PartNumber=partNumber, Body=data)
+        return {'PartNumber': partNumber, 'ETag': response['ETag']}
+    finally:
+        PART_BUFFERS.release()
+
+def upload_object(file:str, objKey:str) -> dict:
+    # reads the file once in fixed-size parts, hashing them on the way - at most UPLOAD_BUFFER_MB of parts are in memory across all uploads
+    sha256 = hashlib.sha256()
+    with open(file, 'rb', buffering=0) as fileobj:
+        if os.fstat(fileobj.fileno()).st_size <= PART_SIZE:
+            data = read_part(fileobj, sha256)
+            try:
+                S3_CLIENT.put_object(Bucket=S3_BUCKET, Key=objKey, Body=data)
+            finally:
+                PART_BUFFERS.release()
+            return {'size_bytes': len(data), 'sha256': sha256.hexdigest()}
+
+        uploadId = S3_CLIENT.create_multipart_upload(Bucket=S3_BUCKET, Key=objKey)['UploadId']
+        parts = []; inFlight = set(); size = 0
+        try:
+            while True:
+                if len(inFlight) >= UPLOAD_PART_CONCURRENCY:
+                    done, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+                    parts += [future.result() for future in done]
+                data = read_part(fileobj, sha256)
+                if not data:
+                    PART_BUFFERS.release()
+                    break
+                size += len(data)
+                inFlight.add(PART_EXECUTOR.submit(upload_part, objKey, uploadId, len(parts) + len(inFlight) + 1, data))
+            parts += [future.result() for future in wait(inFlight).done]
+            S3_CLIENT.complete_multipart_upload(Bucket=S3_BUCKET, Key=objKey, UploadId=uploadId,
+                MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])}
+            )
+        except BaseException:
+            for future in inFlight:
+                if future.cancel(): # never started - its part buffer is released here
+                    PART_BUFFERS.release()
+            wait(inFlight)
+            S3_CLIENT.abort_multipart_upload(Bucket=S3_BUCKET, Key=objKey, UploadId=uploadId)
+            raise
+    return {'size_bytes': size, 'sha256': sha256.hexdigest()}
+
+def load_journal() -> dict:
+    # progress of a previous, unfinished run: {'snapshot': snapshotDir, 'files': {objKey: {'size_bytes', 'sha256'}}}
+    try:
+        with open(UPLOAD_JOURNAL_FILE) as journalfile:
+            journal = json.load(journalfile)
+        if os.path.isdir(journal['snapshot']):
+            return journal
+    except (OSError, ValueError, KeyError) as e:
+        logging.debug(f"no upload journal to resume from: {e}")
+    return None
+
+def save_journal(journal:dict):
+    # atomic, so a hook killed mid-write leaves the previous journal
+    with open(f"{UPLOAD_JOURNAL_FILE}.tmp", 'w') as journalfile:
+        json.dump(journal, journalfile)
+    os.replace(f"{UPLOAD_JOURNAL_FILE}.tmp", UPLOAD_JOURNAL_FILE)
 
-        # read meta.json to metadata
+def upload_snapshot_blocks(snapshotDir:str, journal:dict, deadline:float=None) -> bool:
+    # returns whether every block was uploaded
+    def upload_file(file:str) -> dict:
+        # returns the size and checksum of the file, or None when skipped for the deadline
+        objKey = file.removeprefix(f"{snapshotDir}/")
+        if objKey in journal['files']: # uploaded by a previous run
+            return journal['files'][objKey]
+        if deadline is not None and time.monotonic() > deadline:
+            logging.warning(f"upload deadline reached - skipping {file}")
+            return None
+        return upload_object(file, objKey) # NOTE: boto3 doesn't support sync at the moment
+
+    def upload_meta(blockDir:str) -> dict:
+        # meta.json is the commit marker of a block - built from the sizes and checksums recorded during the upload
+        metaKey = f"{blockDir.removeprefix(f'{snapshotDir}/')}/meta.json"
+        if metaKey in journal['files']: # uploaded by a previous run
+            return journal['files'][metaKey]
         with open(f"{blockDir}/meta.json") as metafile:
             metadata = json.load(metafile)
-        
-        # init thanos field in metadata
         metadata['thanos'] = init_thanos_meta()
-
-        # add index size
-        metadata['thanos']['files'].append({
-            "rel_path": "index",
-            "size_bytes": os.path.getsize(f"{blockDir}/index")
-        })
-
-        chunks = os.listdir(f"{blockDir}/chunks")
-        for chunk in chunks:
-            metadata['thanos']['segment_files'].append(str(chunk))
+        for file in [f"{blockDir}/index"] + chunks[blockDir]:
+            relPath = file.removeprefix(f"{blockDir}/")
+            uploaded = journal['files'][file.removeprefix(f"{snapshotDir}/")]
+            if relPath.startswith('chunks/'):
+                metadata['thanos']['segment_files'].append(relPath.removeprefix('chunks/'))
             metadata['thanos']['files'].append({
-                "rel_path": f"chunks/{chunk}",
-                "size_bytes": os.path.getsize(f"{blockDir}/chunks/{chunk}")
+                "rel_path": relPath,
+                "size_bytes": uploaded['size_bytes'],
+                "hash": {"func": "SHA256", "value": uploaded['sha256']}
             })
-        
-        # overwrite meta.json
-        with open(f"{blockDir}/meta.json", "w") as metafile:
-            json.dump(metadata, metafile, indent=3)
-        
-        # upload block
-        upload_block(snapshotDir, blockDir, chunks)
+        body = json.dumps(metadata, indent=3).encode()
+        if deadline is not None and time.monotonic() > deadline:
+            logging.warning(f"upload deadline reached - skipping {blockDir}/meta.json")
+            return None
+        S3_CLIENT.put_object(Bucket=S3_BUCKET, Key=metaKey, Body=body) # uploaded from memory - the snapshot's meta.json is a hard link to the live block's
+        return {'size_bytes': len(body), 'sha256': hashlib.sha256(body).hexdigest()}
+
+    blocks = []; chunks = {}
+    for block in unshipped_blocks(snapshotDir):
+        blockDir = f"{snapshotDir}/{block}"
+        with open(f"{blockDir}/meta.json") as metafile:
+            maxTime = json.load(metafile)['maxTime']
+        chunks[blockDir] = [f"{blockDir}/chunks/{chunk}" for chunk in sorted(os.listdir(f"{blockDir}/chunks"))]
+        blocks.append((maxTime, blockDir, [f"{blockDir}/index"] + chunks[blockDir]))
+    
+    # newest blocks first - they are the ones the sidecar hasn't shipped yet and the first to be lost when the deadline hits
+    blocks.sort(reverse=True)
+
+    # upload files of the blocks concurrently, in priority order with at most UPLOAD_WORKERS in flight -
+    # a block's meta.json goes last, once all of its data files are uploaded, but ahead of the files of older blocks
+    queue = deque((blockDir, file) for _, blockDir, files in blocks for file in files)
+    remaining = {blockDir: len(files) for _, blockDir, files in blocks} # blockDir -> data files not uploaded yet (-1 when skipped)
+    resumed = len(journal['files'])
+    if resumed:
+        logging.info(f"resuming upload of {snapshotDir} - {resumed} files already uploaded")
+    start = time.monotonic(); uploadedBytes = 0
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        pending = {} # future -> (blockDir, file)
+        while queue or pending:
+            while queue and len(pending) < UPLOAD_WORKERS:
+                blockDir, file = queue.popleft()
+                upload = upload_meta if file is None else upload_file
+                pending[executor.submit(upload, blockDir if file is None else file)] = (blockDir, file)
+            
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            error = None
+            for future in done:
+                blockDir, file = pending.pop(future)
+                if future.exception() is not None: # journal the other completed uploads before failing
+                    error = future.exception()
+                    continue
+                uploaded = future.result()
+                if uploaded is None: # skipped - the block stays incomplete and its meta.json is never uploaded
+                    remaining[blockDir] = -1
+                    continue
+                objKey = (file or f"{blockDir}/meta.json").removeprefix(f"{snapshotDir}/")
+                if objKey not in journal['files']:
+                    uploadedBytes += uploaded['size_bytes']
+                    journal['files'][objKey] = uploaded
+                    save_journal(journal)
+                if file is not None and remaining[blockDir] > 0:
+                    remaining[blockDir] -= 1
+                    if remaining[blockDir] == 0:
+                        queue.appendleft((blockDir, None)) # meta.json
+            if error is not None:
+                raise error
+    
+    elapsed = time.monotonic() - start
+    skipped = [blockDir for blockDir, count in remaining.items() if count < 0]
+    logging.info(f"uploaded {len(blocks) - len(skipped)}/{len(blocks)} blocks ({uploadedBytes / 1e6:.1f} MB) in {elapsed:.1f}s - {uploadedBytes / 1e6 / max(elapsed, 1e-3):.1f} MB/s")
+    if skipped:
+        logging.error(f"upload deadline reached before uploading blocks: {skipped} - progress is kept in {UPLOAD_JOURNAL_FILE}")
+    return not skipped
 
 def main():
+    deadline = time.monotonic() + UPLOAD_DEADLINE if UPLOAD_DEADLINE > 0 else None
+
     # setup logger
     setup_logger() 
 
-    # take TSDB snapshot using Prometheus HTTP API
-    snapshotDir = request_tsdb_snapshot() 
+    # resume the snapshot of an unfinished run, or take TSDB snapshot using Prometheus HTTP API
+    journal = load_journal()
+    if journal is None:
+        journal = {'snapshot': request_tsdb_snapshot(), 'files': {}}
+        save_journal(journal)
 
-    # update each block's meta.json for thanos data and then upload block to S3
-    upload_snapshot_blocks(snapshotDir) 
+    # upload each block to S3, with its meta.json updated for thanos data
+    if not upload_snapshot_blocks(journal['snapshot'], journal, deadline):
+        return
     
     # wipe out relevant folders/files (e.g. /prometheus/snapshots)
     cleanup()
+    os.remove(UPLOAD_JOURNAL_FILE)
 
 if __name__ == '__main__':
     main()
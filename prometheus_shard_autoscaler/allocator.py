@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import time
+import telemetry
+
+class BudgetAllocator:
+    """
+    Fleet-wide budget of shards and requested memory shared by the autoscaled Prometheus objects.
+
+    Every evaluation reports the current size of its Prometheus (`observe`). Scale
+    decisions that grow the shards or the requested memory ask for a grant
+    (`request`) instead of patching right away, and the other evaluations
+    report that they have nothing to grow (`report`). The first request opens
+    an allocation round, which is settled once every object the `scheduler`
+    evaluates within `window` seconds has decided, so a cluster-wide spike that
+    makes many objects scale at once is settled together instead of first come
+    first served. A round settles early for an emergency, or when every
+    evaluation slot is held by a request waiting on it, and at the latest after
+    `window` seconds.
+
+    A round grants the requests by descending priority (emergencies first), and
+    shares what is left between requests of the same priority one shard at a
+    time. A request that doesn't fit is trimmed to the shards that fit or
+    deferred, and asked for again by the next evaluation. Requests that change
+    the memory request per shard (algorithm 'joint') are granted whole or not
+    at all, since their request is only sized for the desired shards.
+
+    With scope 'namespace' the budget applies to each namespace separately,
+    with 'cluster' to all objects together. A budget of 0 is unlimited.
+    Every round accounts for the objects returned by `listUsage` - every
+    autoscaled object, also the ones not evaluated yet or owned by another
+    replica - against the whole budget.
+    """
+    def __init__(self, logger, maxShards:int=0, maxMemory:int=0, scope:str='cluster', window:float=5,
+            scheduler=None, listUsage=None):
+        if scope not in ('namespace', 'cluster'):
+            raise Exception(f"provided budget scope, {scope}, must be 'namespace' or 'cluster'")
+        self.logger = logger
+        self.maxShards = maxShards
+        self.maxMemory = maxMemory
+        self.scope = scope
+        self.window = window # max time a round waits for the decisions of the cycle
+        self.scheduler = scheduler # EvaluationScheduler of the objects - None waits the whole window
+        self.listUsage = listUsage # async callable() -> {key: (shards, memoryPerShard)} of every object accounted here
+        self._usage = {} # key -> (shards, reserved memory bytes per shard)
+        self._pending = {} # key -> (desiredShards, memoryPerShard, (urgent, priority), divisible, future)
+        self._round = None
+        self._waiting = set() # keys the round waits for
+        self._settled = None # set once the round can be allocated
+
+    def pool(self, key) -> str:
+        # budget pool of a (namespace, name) key - '' for the whole cluster
+        return key[0] if self.scope == 'namespace' else ''
+
+    def observe(self, key, shards:int, memoryPerShard:int):
+        self._usage[key] = (shards, memoryPerShard)
+
+    def forget(self, key):
+        self._usage.pop(key, None)
+        pending = self._pending.pop(key, None)
+        if pending is not None and not pending[-1].done():
+            pending[-1].set_result(None)
+        self.report(key)
+
+    def report(self, key):
+        # the evaluation of key has decided for the round (a request, or nothing to grow)
+        if self._round is None or self.scheduler is None:
+            return
+        self._waiting.discard(key)
+        if not self._waiting or (self.scheduler is not None and self.scheduler.stalled(set(self._pending))):
+            self._settled.set()
+
+    async def request(self, key, desiredShards:int, memoryPerShard:int, priority:int=0, urgent:bool=False) -> int:
+        # shards granted for a scale to desiredShards x memoryPerShard - None when the scale is deferred
+        _, currMemoryPerShard = self._usage.get(key, (0, memoryPerShard))
+        divisible = memoryPerShard == currMemoryPerShard
+        future = asyncio.get_event_loop().create_future()
+        previous = self._pending.pop(key, None)
+        if previous is not None and not previous[-1].done(): # superseded by the newer decision
+            previous[-1].set_result(None)
+        self._pending[key] = (desiredShards, memoryPerShard, (urgent, priority), divisible, future)
+        if self._round is None:
+            self._settled = asyncio.Event()
+            if self.scheduler is not None:
+                self._waiting = self.scheduler.due(time.monotonic() + self.window)
+            self._round = asyncio.ensure_future(self._run_round())
+        self.report(key)
+        if urgent: # emergencies don't wait for the rest of the cycle
+            self._settled.set()
+        return await future
+
+    async def _run_round(self):
+        try:
+            await asyncio.wait_for(self._settled.wait(), self.window) # collect the decisions of the cycle
+        except asyncio.TimeoutError:
+            self.logger.debug(f"budget round settled after {self.window}s without the decisions of {len(self._waiting)} object(s)")
+        finally:
+            self._round = None
+            pending, self._pending = self._pending, {}
+        if self.listUsage is not None:
+            try:
+                self._usage = await self.listUsage()
+            except Exception as e:
+                self.logger.warning(f"failed to list the autoscaled prometheus objects for the budget - using the evaluated ones: {e}")
+        grants = self.allocate(pending)
+        for key, (_, _, _, _, future) in pending.items():
+            if not future.done():
+                future.set_result(grants.get(key))
+
+    def allocate(self, pending:dict) -> dict:
+        # key -> granted shards (None when deferred) for the pending requests of one round
+        used = {} # pool -> [shards, memory bytes]
+        for key, (shards, memoryPerShard) in self._usage.items():
+            poolUsed = used.setdefault(self.pool(key), [0, 0])
+            poolUsed[0] += shards
+            poolUsed[1] += shards * memoryPerShard
+
+        grants = {key: None for key in pending}
+        byPool = {}
+        for key in pending:
+            byPool.setdefault(self.pool(key), []).append(key)
+        for pool, keys in byPool.items():
+            poolUsed = used.setdefault(pool, [0, 0])
+            keys.sort(key=lambda k: pending[k][2], reverse=True)
+            for _, group in itertools.groupby(keys, lambda k: pending[k][2]):
+                group = list(group)
+                granted = {key: self._usage.get(key, (0, 0)) for key in group} # key -> (shards, memoryPerShard) granted so far
+                progress = True
+                while progress: # one step per request per pass - requests of the same priority share the headroom
+                    progress = False
+                    for key in group:
+                        desiredShards, memoryPerShard, _, divisible, _ = pending[key]
+                        shards, currMemoryPerShard = granted[key]
+                        if (shards, currMemoryPerShard) == (desiredShards, memoryPerShard):
+                            continue
+                        nextShards = shards + 1 if divisible and shards < desiredShards else desiredShards
+                        extraShards = nextShards - shards
+                        extraMemory = nextShards * memoryPerShard - shards * currMemoryPerShard
+                        if (self.maxShards and extraShards > 0 and poolUsed[0] + extraShards > self.maxShards) or \
+                                (self.maxMemory and extraMemory > 0 and poolUsed[1] + extraMemory > self.maxMemory):
+                            continue
+                        poolUsed[0] += extraShards
+                        poolUsed[1] += extraMemory
+                        granted[key] = (nextShards, memoryPerShard)
+                        grants[key] = nextShards
+                        progress = True
+                for key, usage in granted.items():
+                    if grants[key] is not None:
+                        self._usage[key] = usage # until the next evaluation observes the patched spec
+                    desiredShards = pending[key][0]
+                    if grants[key] is None:
+                        self.logger.warning(f"{key[1]} prometheus scale to {desiredShards} shards deferred - not enough {self.scope} budget left")
+                        telemetry.BUDGET_LIMITED_SCALES.labels(*key, 'deferred').inc()
+                    elif grants[key] < desiredShards:
+                        self.logger.warning(f"{key[1]} prometheus scale to {desiredShards} shards trimmed to {grants[key]} shards by the {self.scope} budget")
+                        telemetry.BUDGET_LIMITED_SCALES.labels(*key, 'trimmed').inc()
+        for pool, (shards, memory) in used.items():
+            telemetry.BUDGET_USED.labels(pool, 'shards').set(shards)
+            telemetry.BUDGET_USED.labels(pool, 'memory').set(memory)
+        return grants
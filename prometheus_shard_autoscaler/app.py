@@ -1,12 +1,23 @@
 import asyncio
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+import json
 from math import ceil
 import kopf
 import os
+import socket
+import time
 
 # local imports
-from kube import KubeClient
+from allocator import BudgetAllocator
+from configs import AutoscalingConfigs, ConfigResolver, validate_configs
+from history import UsageHistory
+from kube import KubeClient, PodMetricsCache, MEBIBYTE, PROM_OPERATOR_LABEL_PREFIX
+from membership import Membership
+from podwatch import PodWatcher
+from signals import ShardMetricsScraper
+from scheduler import EvaluationScheduler
+import telemetry
 import utils
 
 # KOPF PARAMETERS
@@ -20,162 +31,609 @@ PROM_CRD = {
 PROM_AUTOSCALER_DAEMON_DELAY = int(os.getenv('PROM_AUTOSCALER_DAEMON_DELAY', '0')) # time to delay daemon start when operator startsup OR an autoscaling Prometheus is created
 PROM_AUTOSCALER_KEY_PREFIX = os.getenv('PROM_AUTOSCALER_KEY_PREFIX', 'prom-shard-autoscaling.zbialikcloud.io') 
 PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY = f"{PROM_AUTOSCALER_KEY_PREFIX}/scale-time"
+PROM_AUTOSCALER_STATE_ANNOTATION_KEY = f"{PROM_AUTOSCALER_KEY_PREFIX}/scaler-state" # last desired shards, warmup start and usage summary - restored on daemon start
+PROM_AUTOSCALER_METRICS_CACHE_SCOPE = os.getenv('PROM_AUTOSCALER_METRICS_CACHE_SCOPE', 'namespace') # 'namespace' issues one metrics LIST per namespace, 'cluster' one LIST for all namespaces
+PROM_AUTOSCALER_METRICS_RESOLUTION = int(os.getenv('PROM_AUTOSCALER_METRICS_RESOLUTION', '15')) # metrics-server --metric-resolution (seconds)
+PROM_AUTOSCALER_METRICS_CACHE_MIN_TTL = int(os.getenv('PROM_AUTOSCALER_METRICS_CACHE_MIN_TTL', '5')) # min time to reuse cached pod metrics (seconds)
+PROM_AUTOSCALER_METRICS_MAX_AGE = float(os.getenv('PROM_AUTOSCALER_METRICS_MAX_AGE', '120')) # pod metrics samples older than this are excluded from the usage (seconds)
+PROM_AUTOSCALER_METRICS_RECORD_FILE = os.getenv('PROM_AUTOSCALER_METRICS_RECORD_FILE', '') # append every fetched pod metrics list to this file for the simulator (disabled when empty)
+PROM_AUTOSCALER_API_WORKERS = int(os.getenv('PROM_AUTOSCALER_API_WORKERS', '8')) # max concurrent blocking kubernetes api calls
+PROM_AUTOSCALER_API_TIMEOUT = float(os.getenv('PROM_AUTOSCALER_API_TIMEOUT', '10')) # per-call kubernetes api timeout (seconds)
+PROM_AUTOSCALER_API_CONNECT_TIMEOUT = float(os.getenv('PROM_AUTOSCALER_API_CONNECT_TIMEOUT', '3')) # kubernetes api connect timeout (seconds)
+PROM_AUTOSCALER_API_POOL_MAXSIZE = int(os.getenv('PROM_AUTOSCALER_API_POOL_MAXSIZE', str(PROM_AUTOSCALER_API_WORKERS))) # keep-alive connections kept to the kubernetes api
+PROM_AUTOSCALER_API_RETRIES = int(os.getenv('PROM_AUTOSCALER_API_RETRIES', '3')) # retries for failed connections and 429/5xx responses
+PROM_AUTOSCALER_API_RETRY_BACKOFF = float(os.getenv('PROM_AUTOSCALER_API_RETRY_BACKOFF', '0.5')) # exponential backoff factor between retries (seconds)
+PROM_AUTOSCALER_EVALUATION_INTERVAL = int(os.getenv('PROM_AUTOSCALER_EVALUATION_INTERVAL', '5')) # default time between evaluations of a Prometheus (seconds)
+PROM_AUTOSCALER_EVENT_DRIVEN = utils.stringToBool(os.getenv('PROM_AUTOSCALER_EVENT_DRIVEN', 'true')) # re-evaluate immediately when a Prometheus spec/annotations or its pods change
+PROM_AUTOSCALER_MIN_WAKEUP_SPACING = float(os.getenv('PROM_AUTOSCALER_MIN_WAKEUP_SPACING', '1')) # min time between event-driven evaluations of a Prometheus (seconds)
+PROM_AUTOSCALER_EVALUATION_JITTER = float(os.getenv('PROM_AUTOSCALER_EVALUATION_JITTER', '0.1')) # fraction of the evaluation interval used to randomly spread evaluations
+PROM_AUTOSCALER_MAX_CONCURRENT_EVALUATIONS = int(os.getenv('PROM_AUTOSCALER_MAX_CONCURRENT_EVALUATIONS', '10')) # global limit on in-flight evaluations
+PROM_AUTOSCALER_HISTORY_CAPACITY = int(os.getenv('PROM_AUTOSCALER_HISTORY_CAPACITY', '1024')) # max per-pod usage samples kept per Prometheus for windowed usage calculators
+PROM_AUTOSCALER_ERROR_BACKOFF = int(os.getenv('PROM_AUTOSCALER_ERROR_BACKOFF', '60')) # time to pause evaluations of a Prometheus after max errors are reached (seconds)
+PROM_AUTOSCALER_TELEMETRY_PORT = int(os.getenv('PROM_AUTOSCALER_TELEMETRY_PORT', '8000')) # port serving the autoscaler's own /metrics (0 disables)
+PROM_AUTOSCALER_OOM_WINDOW = int(os.getenv('PROM_AUTOSCALER_OOM_WINDOW', '600')) # OOMKilled/crash-looping Prometheus containers that terminated within this time (seconds) trigger an emergency scale-up
+PROM_AUTOSCALER_CRASHLOOP_RESTARTS = int(os.getenv('PROM_AUTOSCALER_CRASHLOOP_RESTARTS', '3')) # restarts of a Prometheus container killed with exit code 137 that count as an out of memory crash loop
+PROM_AUTOSCALER_DRY_RUN = utils.stringToBool(os.getenv('PROM_AUTOSCALER_DRY_RUN', 'false')) # log the patches of Prometheus objects instead of sending them
+PROM_AUTOSCALER_BUDGET_MAX_SHARDS = int(os.getenv('PROM_AUTOSCALER_BUDGET_MAX_SHARDS', '0')) # max total shards of the autoscaled Prometheus objects per budget scope (0 disables)
+PROM_AUTOSCALER_BUDGET_MAX_MEMORY = utils.parse_bytes(os.getenv('PROM_AUTOSCALER_BUDGET_MAX_MEMORY', '0')) # max total requested memory (shards x replicas x request) per budget scope (0 disables)
+PROM_AUTOSCALER_BUDGET_SCOPE = os.getenv('PROM_AUTOSCALER_BUDGET_SCOPE', 'cluster') # 'cluster' shares the budget across all namespaces, 'namespace' applies it to each namespace
+PROM_AUTOSCALER_BUDGET_WINDOW = float(os.getenv('PROM_AUTOSCALER_BUDGET_WINDOW', '5')) # max time (seconds) scale decisions wait for the other objects evaluated within it before the budget is allocated between them
+PROM_AUTOSCALER_PARTITIONED = utils.stringToBool(os.getenv('PROM_AUTOSCALER_PARTITIONED', 'false')) # partition Prometheus objects across operator replicas using Lease membership
+PROM_AUTOSCALER_REPLICA_ID = os.getenv('PROM_AUTOSCALER_REPLICA_ID', os.getenv('POD_NAME', socket.gethostname())) # unique identity of this operator replica
+PROM_AUTOSCALER_LEASE_NAMESPACE = os.getenv('PROM_AUTOSCALER_LEASE_NAMESPACE', os.getenv('POD_NAMESPACE', 'monitoring')) # namespace of the replica membership Leases
+PROM_AUTOSCALER_LEASE_DURATION = float(os.getenv('PROM_AUTOSCALER_LEASE_DURATION', '15')) # time (seconds) after which a replica that stopped renewing its Lease loses its objects
+PROM_AUTOSCALER_LEASE_RENEW_INTERVAL = float(os.getenv('PROM_AUTOSCALER_LEASE_RENEW_INTERVAL', '5')) # time (seconds) between renewals of a replica's Lease
+
+# DEFAULT AUTOSCALING CONFIGS: parsed from os env once - overridden per Prometheus by annotations
+DEFAULT_CONFIGS = AutoscalingConfigs(
+    evaluation_interval=PROM_AUTOSCALER_EVALUATION_INTERVAL,
+    disable_scale_down=utils.stringToBool(os.getenv('PROM_AUTOSCALER_DISABLE_SCALE_DOWN', 'false')),
+    min_shards=int(os.getenv('PROM_AUTOSCALER_MIN_SHARDS', '1')),
+    max_shards=int(os.getenv('PROM_AUTOSCALER_MAX_SHARDS', '7')),
+    target_memory_util=Decimal(os.getenv('PROM_AUTOSCALER_TARGET_MEM_UTIL', '0.75')),
+    min_warmup_scale_up=int(os.getenv('PROM_AUTOSCALER_MIN_WARMUP_SCALE_UP', '60')),
+    min_warmup_scale_down=int(os.getenv('PROM_AUTOSCALER_MIN_WARMUP_SCALE_DOWN', '1800')),
+    min_cooldown=int(os.getenv('PROM_AUTOSCALER_MIN_COOLDOWN', '1800')),
+    desired_shards_algorithm=os.getenv('PROM_AUTOSCALER_DESIRED_SHARDS_ALOGORITHM', 'double-or-decrement'),
+    current_usage_calculator=os.getenv('PROM_AUTOSCALER_CURR_USAGE_CALCULATOR', 'avg'),
+    skew_policy=os.getenv('PROM_AUTOSCALER_SKEW_POLICY', 'none'),
+    usage_window=int(os.getenv('PROM_AUTOSCALER_USAGE_WINDOW', '300')),
+    ewma_alpha=float(os.getenv('PROM_AUTOSCALER_EWMA_ALPHA', '0.3')),
+    predictive_lead_time=int(os.getenv('PROM_AUTOSCALER_PREDICTIVE_LEAD_TIME', '300')),
+    scaling_signals=os.getenv('PROM_AUTOSCALER_SCALING_SIGNALS', 'memory'),
+    target_cpu_util=Decimal(os.getenv('PROM_AUTOSCALER_TARGET_CPU_UTIL', '0.75')),
+    target_head_series=int(os.getenv('PROM_AUTOSCALER_TARGET_HEAD_SERIES', '0')),
+    target_samples_rate=int(os.getenv('PROM_AUTOSCALER_TARGET_SAMPLES_RATE', '0')),
+    shard_metrics_port=int(os.getenv('PROM_AUTOSCALER_SHARD_METRICS_PORT', '9090')),
+    target_memory_util_scale_up=Decimal(os.getenv('PROM_AUTOSCALER_TARGET_MEM_UTIL_SCALE_UP', '0.75')),
+    target_memory_util_scale_down=Decimal(os.getenv('PROM_AUTOSCALER_TARGET_MEM_UTIL_SCALE_DOWN', '0.25')),
+    min_decrement=int(os.getenv('PROM_AUTOSCALER_MIN_DECREMENT', '0')),
+    min_increment=int(os.getenv('PROM_AUTOSCALER_MIN_INCREMENT', '0')),
+    max_decrement=int(os.getenv('PROM_AUTOSCALER_MAX_DECREMENT', '0')),
+    max_increment=int(os.getenv('PROM_AUTOSCALER_MAX_INCREMENT', '0')),
+    emergency_scale_up_step=int(os.getenv('PROM_AUTOSCALER_EMERGENCY_SCALE_UP_STEP', '1')),
+    emergency_cooldown=int(os.getenv('PROM_AUTOSCALER_EMERGENCY_COOLDOWN', '300')),
+    min_memory_request=os.getenv('PROM_AUTOSCALER_MIN_MEMORY_REQUEST', '1Gi'),
+    max_memory_request=os.getenv('PROM_AUTOSCALER_MAX_MEMORY_REQUEST', '32Gi'),
+    node_allocatable_memory=os.getenv('PROM_AUTOSCALER_NODE_ALLOCATABLE_MEMORY', '0'),
+    budget_priority=int(os.getenv('PROM_AUTOSCALER_BUDGET_PRIORITY', '0'))
+)
+validate_configs(DEFAULT_CONFIGS)
 
 # CONSTANTS
-EVALUATION_INTERVAL = 5 # seconds
 LOGGER = None
+KUBECLIENT = None
+SCHEDULER = None
+SCHEDULER_TASK = None
+MEMBERSHIP = None
+MEMBERSHIP_TASK = None
+ALLOCATOR = None
+POD_WATCHER = None
+POD_WATCHER_TASK = None
+PROM_POD_ENDPOINTS = {} # (namespace, prometheus name) -> {pod name: pod ip} - used to scrape shard metrics
+EMERGENCIES = {} # (namespace, prometheus name) -> (time, reason) of the last out of memory termination of one of its pods
+OOM_HANDLED = {} # (namespace, pod name) -> containerID of the last termination handled
+POD_METRICS_CACHE = PodMetricsCache(
+    scope=PROM_AUTOSCALER_METRICS_CACHE_SCOPE,
+    resolution=PROM_AUTOSCALER_METRICS_RESOLUTION,
+    minTtl=PROM_AUTOSCALER_METRICS_CACHE_MIN_TTL,
+    recordFile=PROM_AUTOSCALER_METRICS_RECORD_FILE
+)
+API_EXECUTOR = ThreadPoolExecutor(max_workers=PROM_AUTOSCALER_API_WORKERS, thread_name_prefix='kube-api')
+LEASE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kube-lease') # lease renewals never wait behind slow api calls
 
 @kopf.on.startup()
-def configure(logger, settings: kopf.OperatorSettings, **_):
+async def configure(logger, settings: kopf.OperatorSettings, **_):
     settings.persistence.finalizer = f"{PROM_AUTOSCALER_KEY_PREFIX}/finalizer"
-    global LOGGER
+    global LOGGER, KUBECLIENT, SCHEDULER, SCHEDULER_TASK, MEMBERSHIP, MEMBERSHIP_TASK, ALLOCATOR, POD_WATCHER, POD_WATCHER_TASK
     LOGGER = logger
+    KUBECLIENT = KubeClient(logger=LOGGER, 
+        metricsCache=POD_METRICS_CACHE, 
+        executor=API_EXECUTOR, 
+        leaseExecutor=LEASE_EXECUTOR,
+        requestTimeout=PROM_AUTOSCALER_API_TIMEOUT,
+        connectTimeout=PROM_AUTOSCALER_API_CONNECT_TIMEOUT,
+        poolMaxsize=PROM_AUTOSCALER_API_POOL_MAXSIZE,
+        retries=PROM_AUTOSCALER_API_RETRIES,
+        retryBackoff=PROM_AUTOSCALER_API_RETRY_BACKOFF,
+        metricsMaxAge=PROM_AUTOSCALER_METRICS_MAX_AGE,
+        dryRun=PROM_AUTOSCALER_DRY_RUN
+    )
+    if PROM_AUTOSCALER_PARTITIONED:
+        settings.peering.standalone = True # every replica runs the daemons - only the owner of an object evaluates it
+        MEMBERSHIP = Membership(LOGGER, KUBECLIENT, 
+            identity=PROM_AUTOSCALER_REPLICA_ID, 
+            namespace=PROM_AUTOSCALER_LEASE_NAMESPACE, 
+            leasePrefix='prometheus-shard-autoscaler', 
+            labelKey=f"{PROM_AUTOSCALER_KEY_PREFIX}/member",
+            leaseDuration=PROM_AUTOSCALER_LEASE_DURATION,
+            renewInterval=PROM_AUTOSCALER_LEASE_RENEW_INTERVAL
+        )
+        MEMBERSHIP_TASK = asyncio.create_task(MEMBERSHIP.run())
+    SCHEDULER = EvaluationScheduler(LOGGER, 
+        interval=PROM_AUTOSCALER_EVALUATION_INTERVAL, 
+        jitter=PROM_AUTOSCALER_EVALUATION_JITTER, 
+        maxConcurrency=PROM_AUTOSCALER_MAX_CONCURRENT_EVALUATIONS,
+        minWakeSpacing=PROM_AUTOSCALER_MIN_WAKEUP_SPACING,
+        owns=owns_object if MEMBERSHIP is not None else None
+    )
+    if PROM_AUTOSCALER_BUDGET_MAX_SHARDS or PROM_AUTOSCALER_BUDGET_MAX_MEMORY:
+        ALLOCATOR = BudgetAllocator(LOGGER, 
+            maxShards=PROM_AUTOSCALER_BUDGET_MAX_SHARDS, 
+            maxMemory=PROM_AUTOSCALER_BUDGET_MAX_MEMORY, 
+            scope=PROM_AUTOSCALER_BUDGET_SCOPE, 
+            window=PROM_AUTOSCALER_BUDGET_WINDOW,
+            scheduler=SCHEDULER,
+            listUsage=list_budget_usage
+        )
+    SCHEDULER_TASK = asyncio.create_task(SCHEDULER.run())
+    POD_WATCHER = PodWatcher(LOGGER, KUBECLIENT, f"{PROM_OPERATOR_LABEL_PREFIX}/name", prom_pod_event) # server-side selector - kopf filters labels on the client
+    POD_WATCHER_TASK = asyncio.create_task(POD_WATCHER.run())
+    if PROM_AUTOSCALER_TELEMETRY_PORT:
+        telemetry.start(PROM_AUTOSCALER_TELEMETRY_PORT)
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    if SCHEDULER_TASK is not None:
+        SCHEDULER_TASK.cancel()
+    if POD_WATCHER_TASK is not None:
+        POD_WATCHER_TASK.cancel()
+    if MEMBERSHIP_TASK is not None:
+        MEMBERSHIP_TASK.cancel()
+        try:
+            await MEMBERSHIP.leave()
+        except Exception as e:
+            LOGGER.warning(f"failed to release membership lease: {e}")
+
+def owns_object(key:tuple) -> bool:
+    # whether this replica evaluates the Prometheus - the series of objects owned by other replicas are dropped
+    if MEMBERSHIP.owns(key):
+        return True
+    telemetry.forget(*key)
+    return False
+
+async def list_budget_usage() -> dict:
+    # size of every autoscaled Prometheus in the budget - also the ones not evaluated yet, or owned by another replica
+    usage = {}
+    for prom in await KUBECLIENT.list_proms(PROM_CRD):
+        metadata = prom['metadata']
+        key = (metadata['namespace'], metadata['name'])
+        if metadata.get('annotations', {}).get(f"{PROM_AUTOSCALER_KEY_PREFIX}/enable") != 'true':
+            continue
+        usage[key] = (prom['spec'].get('shards') or 1, reserved_memory_per_shard(prom['spec']))
+    return usage
+
+# PROMETHEUS POD EVENTS: from a watch with a server-side label selector (see PodWatcher)
+async def prom_pod_event(type, pod):
+    metadata = pod['metadata']; status = pod.get('status', {})
+    name = metadata['name']; namespace = metadata['namespace']; labels = metadata.get('labels', {})
+    index_prom_pod_endpoint(name, namespace, labels, status, type)
+    await prom_pod_oom(name, namespace, labels, status, type)
+    if PROM_AUTOSCALER_EVENT_DRIVEN:
+        await prom_pod_changed(namespace, labels)
+
+def index_prom_pod_endpoint(name, namespace, labels, status, type):
+    key = (namespace, labels[f"{PROM_OPERATOR_LABEL_PREFIX}/name"])
+    if type == 'DELETED':
+        PROM_POD_ENDPOINTS.get(key, {}).pop(name, None)
+        if not PROM_POD_ENDPOINTS.get(key, True):
+            del PROM_POD_ENDPOINTS[key]
+    else:
+        PROM_POD_ENDPOINTS.setdefault(key, {})[name] = status.get('podIP')
+
+# OUT OF MEMORY FAST PATH: an OOMKilled or crash-looping prometheus container triggers an emergency scale-up at once
+async def prom_pod_oom(name, namespace, labels, status, type, **_):
+    if type == 'DELETED':
+        OOM_HANDLED.pop((namespace, name), None)
+        return
+    reason = None
+    for containerStatus in status.get('containerStatuses', []):
+        if containerStatus.get('name') != 'prometheus':
+            continue
+        state = containerStatus.get('state', {})
+        terminated = state.get('terminated') or containerStatus.get('lastState', {}).get('terminated')
+        if not terminated or not terminated.get('finishedAt') or utils.now() - utils.parse_timestamp(terminated['finishedAt']) > PROM_AUTOSCALER_OOM_WINDOW:
+            continue
+        if terminated.get('reason') == 'OOMKilled':
+            reason = 'oomkilled'
+        elif terminated.get('exitCode') == 137 and containerStatus.get('restartCount', 0) >= PROM_AUTOSCALER_CRASHLOOP_RESTARTS \
+                and state.get('waiting', {}).get('reason') == 'CrashLoopBackOff': # other crash loops (e.g. bad config) aren't fixed by more shards
+            reason = 'crashloop'
+        if reason is not None and OOM_HANDLED.get((namespace, name)) != terminated.get('containerID'):
+            OOM_HANDLED[(namespace, name)] = terminated.get('containerID')
+            break
+        reason = None
+    if reason is None:
+        return
+
+    key = (namespace, labels[f"{PROM_OPERATOR_LABEL_PREFIX}/name"])
+    LOGGER.warning(f"{name} pod of {key[1]} prometheus terminated out of memory ({reason})")
+    for staleKey in [k for k, (at, _) in EMERGENCIES.items() if utils.now() - at > PROM_AUTOSCALER_OOM_WINDOW]: # recorded by replicas that never own them
+        del EMERGENCIES[staleKey]
+    EMERGENCIES[key] = (utils.now(), reason)
+    if SCHEDULER is not None:
+        SCHEDULER.wake(key, force=True) # even while the evaluations are held by min-cooldown
 
 # DAEMON FOR AUTOSCALING PROMS WITH ANNOTATION: prom-shard-autoscaling.zbialikcloud.io/enable: 'true'
 @kopf.daemon(PROM_CRD['group'], PROM_CRD['version'], PROM_CRD['plural'], 
     annotations={f"{PROM_AUTOSCALER_KEY_PREFIX}/enable": 'true'},
     initial_delay=PROM_AUTOSCALER_DAEMON_DELAY
 )
-async def prom_scaler_async(spec, name, namespace, annotations, labels, patch, **kwargs):
+async def prom_scaler_async(spec, meta, name, namespace, annotations, labels, patch, stopped, **kwargs):
+    key = (namespace, name)
+    resolver = new_config_resolver(name)
+    configs = resolver.resolve(annotations, meta.get('resourceVersion'))
+    shardMetrics = ShardMetricsScraper(LOGGER, 
+        lambda: list(PROM_POD_ENDPOINTS.get(key, {}).items()), 
+        executor=API_EXECUTOR, 
+        port=configs.shard_metrics_port, 
+        timeout=PROM_AUTOSCALER_API_TIMEOUT
+    )
+    evaluate = new_evaluation(KUBECLIENT, name, namespace, spec, annotations, shardMetrics, meta, resolver)
+
+    # evaluations are owned by the central scheduler - the daemon only lives as long as the object
+    SCHEDULER.register(key, evaluate, interval=configs.evaluation_interval)
+    try:
+        await stopped.wait()
+    finally:
+        SCHEDULER.unregister(key)
+        EMERGENCIES.pop(key, None)
+        if ALLOCATOR is not None:
+            ALLOCATOR.forget(key)
+        KUBECLIENT.forget_pod_usage(name, namespace)
+        telemetry.forget(namespace, name)
+
+def new_evaluation(kubeclient:KubeClient, name:str, namespace:str, spec, annotations, 
+        shardMetrics:ShardMetricsScraper = None, 
+        meta = None, 
+        resolver:ConfigResolver = None
+    ):
+    # returns the evaluation callback of a single Prometheus - shared by the operator and the simulator
     
     # init local constants
-    kubeclient = KubeClient(logger=LOGGER)
+    key = (namespace, name)
     countErrorMax = 5
 
     # init variables
     countError = 0
-    countWarmup = 0
+    warmupStart = 0 # time desiredShards first differed from current (0 when not warming up, or when a finished warmup's patch is retried)
     prevDesiredShards = 0
-    configs = get_autoscaling_configs(annotations)
+    prevDesiredMemory = 0 # desired memory request bytes (0 when not managed - only algorithm 'joint' sizes the requests)
+    resolver = resolver or new_config_resolver(name)
+    configs = resolver.resolve(annotations)
+    history = UsageHistory(configs.usage_window, PROM_AUTOSCALER_HISTORY_CAPACITY, configs.ewma_alpha)
+
+    persistedState = (prevDesiredShards, prevDesiredMemory, warmupStart)
+    seenState = None # state annotation last seen on the object
+    writtenState = None # state annotation last written by this evaluation
+    dryRunScale = None # (shards, memory) of the scale last logged in dry run - the spec never changes, so it stays pending
+
+    def restore_state():
+        # resume from the persisted state so restarts and rebalances don't reset warmup progress - the annotations are a live view
+        nonlocal prevDesiredShards, prevDesiredMemory, warmupStart, persistedState, seenState
+        seenState = annotations.get(PROM_AUTOSCALER_STATE_ANNOTATION_KEY)
+        state = load_scaler_state(name, annotations)
+        if state is not None:
+            prevDesiredShards = state['desired']; prevDesiredMemory = state['desiredMemory']; warmupStart = state['warmupStart']
+            if state.get('ewma'):
+                history.restore(state['shards'], *state['ewma'])
+            LOGGER.info(f"{name} prometheus restored scaler state: desiredShards={prevDesiredShards}, warmupStart={warmupStart}")
+        persistedState = (prevDesiredShards, prevDesiredMemory, warmupStart)
+    restore_state()
+
+    async def apply_changes(scaleDirection:str = None, shards:int = None):
+        # the scale (to shards, prevDesiredShards by default), the cooldown timestamp and the scaler state of an evaluation
+        # are written in a single patch, guarded by the resourceVersion the decision was made on
+        nonlocal persistedState, writtenState
+        changes = {}
+        if scaleDirection is not None or PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY not in annotations:
+            changes[PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY] = str(utils.now())
+        if (prevDesiredShards, prevDesiredMemory, warmupStart) != persistedState: # the usage summary rides along
+            changes[PROM_AUTOSCALER_STATE_ANNOTATION_KEY] = dump_scaler_state(spec['shards'], prevDesiredShards, warmupStart, history, prevDesiredMemory)
+        if not changes:
+            return True
+        if MEMBERSHIP is not None and not MEMBERSHIP.owns(key): # lost during the evaluation - the new owner decides
+            LOGGER.info(f"{name} prometheus moved to another replica during its evaluation - not patching")
+            return False
+        
+        start = time.monotonic()
+        patched = await kubeclient.patch_prom(name, namespace, PROM_CRD, 
+            shards=(shards or prevDesiredShards) if scaleDirection is not None else None, 
+            annotations=changes, 
+            resourceVersion=meta.get('resourceVersion') if meta is not None else None,
+            resources=memory_resources(spec, prevDesiredMemory) if scaleDirection is not None and prevDesiredMemory else None
+        )
+        telemetry.EVALUATION_PHASE_LATENCY.labels(phase='patch').observe(time.monotonic() - start)
+        if patched:
+            persistedState = (prevDesiredShards, prevDesiredMemory, warmupStart)
+            if not kubeclient.dryRun:
+                writtenState = changes.get(PROM_AUTOSCALER_STATE_ANNOTATION_KEY, writtenState)
+            if scaleDirection is not None and not kubeclient.dryRun:
+                telemetry.SCALE_EVENTS.labels(namespace, name, scaleDirection).inc()
+        return patched
+
+    def observe_budget():
+        # current size accounted by the fleet budget - also gives back a grant whose patch failed
+        if ALLOCATOR is not None:
+            ALLOCATOR.observe(key, spec['shards'], reserved_memory_per_shard(spec))
 
-    while True:
+    async def request_budget(urgent:bool = False) -> int:
+        # shards of the pending scale granted by the fleet budget - None when the scale is deferred
+        if ALLOCATOR is None:
+            return prevDesiredShards
+        memoryPerShard = reserved_memory_per_shard(spec, prevDesiredMemory)
+        if prevDesiredShards <= spec['shards'] and memoryPerShard <= reserved_memory_per_shard(spec): # nothing grows
+            return prevDesiredShards
+        return await ALLOCATOR.request(key, prevDesiredShards, memoryPerShard, configs.budget_priority, urgent)
+
+    async def emergency_scale_up(reason:str) -> bool:
+        # scale up by emergency-scale-up-step right away - bypassing warmup and min-cooldown, but not emergency-cooldown
+        nonlocal prevDesiredShards, prevDesiredMemory, warmupStart
+        if configs.emergency_scale_up_step == 0:
+            return False
+        if spec['shards'] >= configs.max_shards:
+            LOGGER.warning(f"{name} prometheus is out of memory ({reason}) but already at max shards ({configs.max_shards})")
+            return False
+        secondsSinceScale = utils.now() - float(annotations.get(PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY, 0))
+        if secondsSinceScale < configs.emergency_cooldown:
+            LOGGER.info(f"{name} prometheus is out of memory ({reason}) but scaled {secondsSinceScale:.0f}s ago - skipping emergency scale-up")
+            return False
+
+        prevDesiredShards = min(spec['shards'] + configs.emergency_scale_up_step, configs.max_shards)
+        prevDesiredMemory = 0 # memory requests are left as they are
+        warmupStart = 0
+        LOGGER.warning(f"{name} prometheus is out of memory ({reason}) - emergency scale-up to {prevDesiredShards} shards")
+        grantedShards = await request_budget(urgent=True)
+        if grantedShards is None: # retried once budget is freed
+            EMERGENCIES.setdefault(key, (utils.now(), reason))
+            return False
+        if not await apply_changes('up', grantedShards):
+            observe_budget()
+            EMERGENCIES.setdefault(key, (utils.now(), reason)) # retried on the fresh object
+            return False
+        if not kubeclient.dryRun:
+            telemetry.EMERGENCY_SCALE_UPS.labels(namespace, name, reason).inc()
+        return True
+
+    async def evaluate():
+        # single evaluation run by the scheduler - returns seconds until next evaluation (None for the default interval)
+        nonlocal countError, warmupStart, prevDesiredShards, prevDesiredMemory, configs, dryRunScale, seenState
+        start = time.monotonic()
         try:
-            configs = get_autoscaling_configs(annotations, configs)
+            configs = resolver.resolve(annotations, meta.get('resourceVersion') if meta is not None else None)
+            if SCHEDULER is not None:
+                SCHEDULER.set_interval(key, configs.evaluation_interval)
+            history.configure(configs.usage_window, configs.ewma_alpha)
+            if shardMetrics is not None:
+                shardMetrics.port = configs.shard_metrics_port
+                shardMetrics.routePrefix = spec.get('routePrefix', '/')
+            liveState = annotations.get(PROM_AUTOSCALER_STATE_ANNOTATION_KEY)
+            if liveState != seenState and liveState != writtenState: # written by another replica, e.g. the owner before a rebalance
+                restore_state()
+            seenState = liveState
+            if history.shards != spec['shards']: # per-pod usage before a reshard doesn't describe the new shards
+                history.clear(spec['shards'])
+            observe_budget()
             
-            # cooldown after previous scale event
-            await cooldown(kubeclient, name, namespace, configs['min-cooldown'], annotations)
+            # out of memory terminations of the pods scale up at once - the owner is woken at once, so only emergencies recorded
+            # while another replica owned the object (e.g. before a rebalance) get older than the oom window
+            emergency = EMERGENCIES.pop(key, None)
+            if emergency is not None and utils.now() - emergency[0] <= PROM_AUTOSCALER_OOM_WINDOW:
+                if await emergency_scale_up(emergency[1]):
+                    countError = 0
+                    return None
+
+            # skip evaluations until cooldown after previous scale event ends
+            cooldownSeconds = cooldown(configs.min_cooldown, annotations)
+            telemetry.COOLDOWN_REMAINING_SECONDS.labels(namespace, name).set(cooldownSeconds)
+            if cooldownSeconds > 0:
+                LOGGER.debug(f"{name} prometheus is cooling down - next evaluation in {cooldownSeconds:.0f}s")
+                return cooldownSeconds
 
             # main shard analysis and update sequence
-            prevDesiredShards, countWarmup = scale_sequence(
+            prevDesiredShards, prevDesiredMemory, warmupStart, scaleDirection = await scale_sequence(
                 kubeclient, 
                 name, 
                 namespace, 
                 spec,
                 prevDesiredShards, 
-                countWarmup, 
-                configs
+                warmupStart, 
+                configs,
+                history,
+                shardMetrics,
+                prevDesiredMemory
             )
+            if kubeclient.dryRun: # log a scale once while it stays pending instead of at every evaluation
+                if dryRunScale != (prevDesiredShards, prevDesiredMemory):
+                    dryRunScale = None
+                if scaleDirection is not None and dryRunScale is not None:
+                    scaleDirection = None
+                elif scaleDirection is not None:
+                    dryRunScale = (prevDesiredShards, prevDesiredMemory)
+            grantedShards = None
+            if scaleDirection is not None:
+                grantedShards = await request_budget()
+                if grantedShards is None: # deferred - the warmup is over, so the next evaluation asks again
+                    scaleDirection = None
+            if not await apply_changes(scaleDirection, grantedShards) and grantedShards is not None:
+                observe_budget()
             countError = 0
         
         except Exception as e:
             countError += 1
+            telemetry.EVALUATION_ERRORS.labels(namespace, name).inc()
+            LOGGER.error(f"exception caught in {name} prometheus evaluation: {e}")
             if countError == countErrorMax:
-                raise Exception(f"max errors allowed in main() loop reached ({countErrorMax})")
+                LOGGER.error(f"max errors allowed in {name} prometheus evaluation reached ({countErrorMax}) - pausing evaluations for {PROM_AUTOSCALER_ERROR_BACKOFF}s")
+                countError = 0 # warmup progress is kept - it's persisted and still valid after transient errors
+                return PROM_AUTOSCALER_ERROR_BACKOFF
             else:
-                LOGGER.error(f"exception caught in in main() loop: {e}")
-                LOGGER.warning(f"{countError} error(s) occurred back to back in main() loop out of {countErrorMax} allowed")
+                LOGGER.warning(f"{countError} error(s) occurred back to back in {name} prometheus evaluation out of {countErrorMax} allowed")
         finally:
-            await asyncio.sleep(EVALUATION_INTERVAL)
+            if ALLOCATOR is not None: # decided for the budget round, if one is waiting
+                ALLOCATOR.report(key)
+            telemetry.EVALUATION_PHASE_LATENCY.labels(phase='evaluation').observe(time.monotonic() - start)
+        return None
+
+    return evaluate
+
+# EVENT-DRIVEN WAKEUPS: re-evaluate a Prometheus as soon as its spec, its annotations or its pods change
+if PROM_AUTOSCALER_EVENT_DRIVEN:
+    PROM_OBSERVED = {} # (namespace, name) -> (generation, annotations) last seen on watch events
 
-def scale_sequence(kubeclient:KubeClient, name:str, namespace:str, spec,
+    @kopf.on.event(PROM_CRD['group'], PROM_CRD['version'], PROM_CRD['plural'], 
+        annotations={f"{PROM_AUTOSCALER_KEY_PREFIX}/enable": 'true'}
+    )
+    async def prom_changed(name, namespace, meta, annotations, type, **_):
+        key = (namespace, name)
+        if type == 'DELETED':
+            PROM_OBSERVED.pop(key, None)
+            return
+        # ignore status-only updates and the autoscaler's own annotations
+        observed = (meta.get('generation'), {k: v for k, v in annotations.items() if k not in (PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY, PROM_AUTOSCALER_STATE_ANNOTATION_KEY)})
+        if PROM_OBSERVED.get(key) != observed:
+            PROM_OBSERVED[key] = observed
+            if SCHEDULER is not None:
+                SCHEDULER.wake(key)
+
+    async def prom_pod_changed(namespace, labels, **_): # fed by prom_pod_event
+        if SCHEDULER is not None:
+            SCHEDULER.wake((namespace, labels[f"{PROM_OPERATOR_LABEL_PREFIX}/name"]))
+
+async def scale_sequence(kubeclient:KubeClient, name:str, namespace:str, spec,
         prevDesiredShards:int, 
-        countWarmup:int,
-        configs:dict
+        warmupStart:float,
+        configs:AutoscalingConfigs,
+        history:UsageHistory = None,
+        shardMetrics:ShardMetricsScraper = None,
+        prevDesiredMemory:int = 0
     ):
-    # calculate desired shards
-    desiredShards = kubeclient.calculate_desired_shards(name, namespace, spec, 
-        configs['min-shards'],
-        configs['max-shards'], 
-        disableScaleDown=configs['disable-scale-down'],
-        algorithm=configs['desired-shards-algorithm'],
-        usageCalculator=configs['current-usage-calculator'],
-        targetUtil=configs['target-memory-util'],
-        targetUtilScaleUp=configs['target-memory-util-scale-up'],
-        targetUtilScaleDown=configs['target-memory-util-scale-down'],
-        minDecrement=configs['min-decrement'],
-        minIncrement=configs['min-increment'],
-        maxDecrement=configs['max-decrement'],
-        maxIncrement=configs['max-increment'],
-    )
-    
-    # calculate minimum iterations before executing a scaleUp or scaleDown
-    countWarmupScaleUpMin = ceil(configs['min-warmup-scale-up'] / EVALUATION_INTERVAL)
-    countWarmupScaleDownMin = ceil(configs['min-warmup-scale-down'] / EVALUATION_INTERVAL)
+    # calculate desired shards (and memory request for algorithm 'joint')
+    start = time.monotonic()
+    currMemory = desiredMemory = 0 # memory requests are only managed by algorithm 'joint'
+    if configs.desired_shards_algorithm == 'joint':
+        currMemory = utils.parse_bytes(spec['resources']['requests']['memory'])
+        desiredShards, desiredMemory = await kubeclient.calculate_desired_sizing(name, namespace, spec, 
+            configs.min_shards,
+            configs.max_shards, 
+            *configs.memory_request_bounds,
+            disableScaleDown=configs.disable_scale_down,
+            usageCalculator=configs.current_usage_calculator,
+            skewPolicy=configs.skew_policy,
+            history=history,
+            targetUtil=configs.target_memory_util,
+            prevDesired=(prevDesiredShards, prevDesiredMemory)
+        )
+    else:
+        desiredShards = await kubeclient.calculate_desired_shards(name, namespace, spec, 
+            configs.min_shards,
+            configs.max_shards, 
+            disableScaleDown=configs.disable_scale_down,
+            algorithm=configs.desired_shards_algorithm,
+            usageCalculator=configs.current_usage_calculator,
+            skewPolicy=configs.skew_policy,
+            history=history,
+            targetUtil=configs.target_memory_util,
+            targetUtilScaleUp=configs.target_memory_util_scale_up,
+            targetUtilScaleDown=configs.target_memory_util_scale_down,
+            minDecrement=configs.min_decrement,
+            minIncrement=configs.min_increment,
+            maxDecrement=configs.max_decrement,
+            maxIncrement=configs.max_increment,
+            leadTime=configs.predictive_lead_time,
+            signals=configs.signals,
+            targetCpuUtil=configs.target_cpu_util,
+            targetHeadSeries=configs.target_head_series,
+            targetSamplesRate=configs.target_samples_rate,
+            shardMetrics=shardMetrics,
+        )
+    telemetry.EVALUATION_PHASE_LATENCY.labels(phase='calculate').observe(time.monotonic() - start)
+    telemetry.CURRENT_SHARDS.labels(namespace, name).set(spec['shards'])
+    telemetry.DESIRED_SHARDS.labels(namespace, name).set(desiredShards)
     
-    if desiredShards == spec['shards']: # desired matches current
-        LOGGER.info(f"desiredShards matches current ({spec['shards']})")
-        countWarmup = 0
-    elif desiredShards != prevDesiredShards: # desired doesn't match current AND doesn't match previous
-        LOGGER.info(f"desiredShards ({desiredShards}) has changed from previous evaluation ({prevDesiredShards})")
-        prevDesiredShards = desiredShards
-        countWarmup = 0
-    elif desiredShards > spec['shards']: # desired is greater than current AND matches previous 
-        if countWarmup == countWarmupScaleUpMin:
-            kubeclient.scale_prom_shards(name, namespace, PROM_CRD, desiredShards, PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY)
-            countWarmup = 0
+    # desiredShards must stay at the same new value for min-warmup-* seconds before executing a scaleUp or scaleDown
+    now = utils.now()
+    scaleDirection = None # the shards patch itself is left to the caller, so it's sent along with the annotations
+    if (desiredShards, desiredMemory) == (spec['shards'], currMemory): # desired matches current
+        LOGGER.debug(f"desiredShards matches current ({spec['shards']})")
+        prevDesiredShards = spec['shards']; prevDesiredMemory = currMemory # a later change starts a new warmup instead of resuming this one
+        warmupStart = 0
+    elif (desiredShards, desiredMemory) != (prevDesiredShards, prevDesiredMemory): # desired doesn't match current AND doesn't match previous
+        if desiredMemory:
+            LOGGER.info(f"desiredShards ({desiredShards} x {utils.sizeof_fmt(desiredMemory)}) has changed from previous evaluation ({prevDesiredShards} x {utils.sizeof_fmt(prevDesiredMemory)})")
         else:
-            LOGGER.info(f"waiting {countWarmupScaleUpMin - countWarmup} more {EVALUATION_INTERVAL}s loops before executing shard patch")
-            countWarmup += 1
-    elif desiredShards < spec['shards']: # desired is less than current AND matches previous
-        if countWarmup == countWarmupScaleDownMin:
-            kubeclient.scale_prom_shards(name, namespace, PROM_CRD, desiredShards, PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY)
-            countWarmup = 0
+            LOGGER.info(f"desiredShards ({desiredShards}) has changed from previous evaluation ({prevDesiredShards})")
+        prevDesiredShards = desiredShards; prevDesiredMemory = desiredMemory
+        warmupStart = now
+    elif desiredShards * (desiredMemory or 1) > spec['shards'] * (currMemory or 1): # desired reserves more than current AND matches previous 
+        warmupRemaining = configs.min_warmup_scale_up - (now - warmupStart)
+        if warmupRemaining <= 0:
+            scaleDirection = 'up'
+            warmupStart = 0
         else:
-            LOGGER.info(f"waiting {countWarmupScaleDownMin - countWarmup} more {EVALUATION_INTERVAL}s loops before executing shard patch")
-            countWarmup += 1
-    else: # TODO: remove after proving impossible to reach
-        LOGGER.warning(f"entered a conditional block that should not have been possible")
-        countWarmup = 0
-    return prevDesiredShards, countWarmup
-
-async def cooldown(kubeclient:KubeClient, name, namespace, minCooldownPeriod, annotations:dict):
-    LOGGER.info("determining time to cooldown since last scale")
+            LOGGER.debug(f"waiting {warmupRemaining:.0f}s more before executing shard patch")
+    else: # desired reserves less than current (or as much, with another shards x request split) AND matches previous
+        warmupRemaining = configs.min_warmup_scale_down - (now - warmupStart)
+        if warmupRemaining <= 0:
+            scaleDirection = 'down'
+            warmupStart = 0
+        else:
+            LOGGER.debug(f"waiting {warmupRemaining:.0f}s more before executing shard patch")
+    telemetry.WARMUP_SECONDS.labels(namespace, name).set(now - warmupStart if warmupStart else 0)
+    return prevDesiredShards, prevDesiredMemory, warmupStart, scaleDirection
+
+def cooldown(minCooldownPeriod, annotations:dict) -> float:
+    # returns the seconds remaining in the cooldown since the last scale event
+    LOGGER.debug("determining time to cooldown since last scale")
     
     if PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY not in annotations.keys():
-        LOGGER.info(f"timestamp annotation does not exist on object.")
-        kubeclient.add_timestamp_annotation(name, namespace, PROM_CRD, PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY)
-    else:
-        prevTimestamp = float(annotations[PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY])
-        LOGGER.debug(f"previous update occurred at timestamp: {prevTimestamp}")
-        timedelta = datetime.now() - datetime.fromtimestamp(prevTimestamp)
-        secondsSincePatch = float(timedelta.total_seconds())
-        
-        cooldownSeconds = minCooldownPeriod - secondsSincePatch
-        if cooldownSeconds > 0:
-            await utils.sleep_and_log(cooldownSeconds, LOGGER)
-
-def get_autoscaling_configs(annotations:dict, preConfigs:dict={}):
-    def log_config_settings():
-        LOGGER.info(f"prometheus reloaded with with following autoscaling configs:")
-        for key,value in configs.items():
-            LOGGER.info(f"\t {key} = {str(value)}")
-    
-    configs = { # defaults from os env
-        'disable-scale-down': utils.stringToBool(os.getenv('PROM_AUTOSCALER_DISABLE_SCALE_DOWN', 'false')),
-        'min-shards': int(os.getenv('PROM_AUTOSCALER_MIN_SHARDS', '1')),
-        'max-shards': int(os.getenv('PROM_AUTOSCALER_MAX_SHARDS', '7')),
-        'target-memory-util': Decimal(os.getenv('PROM_AUTOSCALER_TARGET_MEM_UTIL', '0.75')),
-        'min-warmup-scale-up': int(os.getenv('PROM_AUTOSCALER_MIN_WARMUP_SCALE_UP', '60')),
-        'min-warmup-scale-down': int(os.getenv('PROM_AUTOSCALER_MIN_WARMUP_SCALE_DOWN', '1800')),
-        'min-cooldown': int(os.getenv('PROM_AUTOSCALER_MIN_COOLDOWN', '1800')),
-        'desired-shards-algorithm': os.getenv('PROM_AUTOSCALER_DESIRED_SHARDS_ALOGORITHM', 'double-or-decrement'),
-        'current-usage-calculator': os.getenv('PROM_AUTOSCALER_CURR_USAGE_CALCULATOR', 'avg'),
-        'target-memory-util-scale-up': Decimal(os.getenv('PROM_AUTOSCALER_TARGET_MEM_UTIL_SCALE_UP', '0.75')),
-        'target-memory-util-scale-down': Decimal(os.getenv('PROM_AUTOSCALER_TARGET_MEM_UTIL_SCALE_DOWN', '0.25')),
-        'min-decrement': int(os.getenv('PROM_AUTOSCALER_MIN_DECREMENT', '0')),
-        'min-increment': int(os.getenv('PROM_AUTOSCALER_MIN_INCREMENT', '0')),
-        'max-decrement': int(os.getenv('PROM_AUTOSCALER_MAX_DECREMENT', '0')),
-        'max-increment': int(os.getenv('PROM_AUTOSCALER_MAX_INCREMENT', '0'))
-    }
-
-    for key, value in configs.items(): # override defaults with configs from annotations
-        t = type(value) # need to enforce type
-        if t is bool:
-            configs[key] = utils.stringToBool(annotations.get(f"{PROM_AUTOSCALER_KEY_PREFIX}/{key}", str(value)))
-        else:
-            configs[key] = t(annotations.get(f"{PROM_AUTOSCALER_KEY_PREFIX}/{key}", value))
+        LOGGER.debug(f"timestamp annotation does not exist on object - it's added with the evaluation's patch")
+        return 0
     
-    if configs != preConfigs:
-        log_config_settings()
+    prevTimestamp = float(annotations[PROM_AUTOSCALER_TIMESTAMP_ANNOTATION_KEY])
+    LOGGER.debug(f"previous update occurred at timestamp: {prevTimestamp}")
+    secondsSincePatch = utils.now() - prevTimestamp
     
-    return configs
+    return max(minCooldownPeriod - secondsSincePatch, 0)
+
+def memory_resources(spec, memoryRequest:int) -> dict:
+    # resources patch for a new memory request - the memory limit keeps its ratio to the request
+    resources = {'requests': {'memory': f"{memoryRequest // MEBIBYTE}Mi"}}
+    memoryLimit = spec.get('resources', {}).get('limits', {}).get('memory')
+    if memoryLimit:
+        ratio = Decimal(utils.parse_bytes(memoryLimit)) / utils.parse_bytes(spec['resources']['requests']['memory'])
+        resources['limits'] = {'memory': f"{ceil(memoryRequest * ratio / MEBIBYTE)}Mi"}
+    return resources
+
+def reserved_memory_per_shard(spec, memoryRequest:int = 0) -> int:
+    # memory reserved by the replicas of one shard - with the current request unless memoryRequest is given
+    if not memoryRequest:
+        memoryRequest = utils.parse_bytes(spec.get('resources', {}).get('requests', {}).get('memory', '0'))
+    return memoryRequest * (spec.get('replicas') or 1)
+
+def dump_scaler_state(shards:int, desiredShards:int, warmupStart:float, history:UsageHistory = None, desiredMemory:int = 0) -> str:
+    state = {'shards': shards, 'desired': desiredShards, 'warmupStart': round(warmupStart, 1)}
+    if desiredMemory:
+        state['desiredMemory'] = desiredMemory
+    if history is not None and history.ewma()['memory']:
+        state['ewma'] = [round(history.ewma()['cpu'], 4), round(history.ewma()['memory'])]
+    return json.dumps(state, separators=(',', ':'))
+
+def load_scaler_state(name:str, annotations:dict) -> dict:
+    if PROM_AUTOSCALER_STATE_ANNOTATION_KEY not in annotations:
+        return None
+    try:
+        state = json.loads(annotations[PROM_AUTOSCALER_STATE_ANNOTATION_KEY])
+        return {
+            'shards': int(state['shards']), 
+            'desired': int(state['desired']), 
+            'desiredMemory': int(state.get('desiredMemory', 0)), 
+            'warmupStart': float(state['warmupStart']), 
+            'ewma': [float(v) for v in state['ewma']] if 'ewma' in state else None
+        }
+    except (ValueError, TypeError, KeyError) as e:
+        LOGGER.warning(f"ignoring invalid {PROM_AUTOSCALER_STATE_ANNOTATION_KEY} annotation on {name} prometheus: {e}")
+        return None
+
+def new_config_resolver(name:str) -> ConfigResolver:
+    return ConfigResolver(LOGGER, name, DEFAULT_CONFIGS, PROM_AUTOSCALER_KEY_PREFIX)
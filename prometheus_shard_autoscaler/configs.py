@@ -0,0 +1,149 @@
+from decimal import Decimal
+from typing import NamedTuple
+import utils
+
+ALGORITHMS = ('hpa', 'double-or-decrement', 'predictive', 'multi-signal', 'joint')
+USAGE_CALCULATORS = ('avg', 'max', 'p95', 'ewma', 'max-over-window')
+SKEW_POLICIES = ('none', 'median')
+
+class AutoscalingConfigs(NamedTuple):
+    """
+    Immutable autoscaling configs of a Prometheus. Every field can be overridden
+    with the annotation `<key prefix>/<field name with '-' instead of '_'>`.
+    """
+    evaluation_interval: int
+    disable_scale_down: bool
+    min_shards: int
+    max_shards: int
+    target_memory_util: Decimal
+    min_warmup_scale_up: int
+    min_warmup_scale_down: int
+    min_cooldown: int
+    desired_shards_algorithm: str
+    current_usage_calculator: str
+    skew_policy: str
+    usage_window: int
+    ewma_alpha: float
+    predictive_lead_time: int
+    scaling_signals: str
+    target_cpu_util: Decimal
+    target_head_series: int
+    target_samples_rate: int
+    shard_metrics_port: int
+    target_memory_util_scale_up: Decimal
+    target_memory_util_scale_down: Decimal
+    min_decrement: int
+    min_increment: int
+    max_decrement: int
+    max_increment: int
+    emergency_scale_up_step: int
+    emergency_cooldown: int
+    min_memory_request: str
+    max_memory_request: str
+    node_allocatable_memory: str
+    budget_priority: int
+
+    @property
+    def signals(self) -> list:
+        return [signal.strip() for signal in self.scaling_signals.split(',')]
+
+    @property
+    def memory_request_bounds(self) -> tuple:
+        # (min, max) bytes of the per-shard memory request for algorithm 'joint' - a request must fit on a node
+        maxRequest = utils.parse_bytes(self.max_memory_request)
+        nodeAllocatable = utils.parse_bytes(self.node_allocatable_memory)
+        if nodeAllocatable > 0:
+            maxRequest = min(maxRequest, nodeAllocatable)
+        return utils.parse_bytes(self.min_memory_request), maxRequest
+
+# value checks on top of the field type
+CHECKS = {
+    'evaluation_interval': lambda v: v > 0,
+    'min_shards': lambda v: v >= 1,
+    'max_shards': lambda v: v >= 1,
+    'target_memory_util': lambda v: v > 0,
+    'desired_shards_algorithm': lambda v: v in ALGORITHMS,
+    'current_usage_calculator': lambda v: v in USAGE_CALCULATORS,
+    'skew_policy': lambda v: v in SKEW_POLICIES,
+    'usage_window': lambda v: v > 0,
+    'ewma_alpha': lambda v: 0 < v <= 1,
+    'target_cpu_util': lambda v: v > 0,
+    'emergency_scale_up_step': lambda v: v >= 0,
+    'emergency_cooldown': lambda v: v >= 0,
+    'min_memory_request': lambda v: utils.parse_bytes(v) > 0,
+    'max_memory_request': lambda v: utils.parse_bytes(v) > 0,
+    'node_allocatable_memory': lambda v: utils.parse_bytes(v) >= 0,
+}
+
+def annotation_key(keyPrefix:str, field:str) -> str:
+    return f"{keyPrefix}/{field.replace('_', '-')}"
+
+def parse_value(field:str, value:str):
+    # raises an exception when the value doesn't parse to the field type or fails its check
+    fieldType = AutoscalingConfigs.__annotations__[field]
+    parsed = utils.stringToBool(value) if fieldType is bool else fieldType(value)
+    if field in CHECKS and not CHECKS[field](parsed):
+        raise ValueError(f"invalid value {value}")
+    return parsed
+
+def validate_configs(configs:AutoscalingConfigs):
+    for field, check in CHECKS.items():
+        if not check(getattr(configs, field)):
+            raise Exception(f"invalid autoscaling config {field.replace('_', '-')}={getattr(configs, field)}")
+
+class ConfigResolver:
+    """
+    Resolves the configs of a single Prometheus from its annotations.
+
+    Only annotations whose value changed since the previous call are parsed,
+    and nothing is compared at all while the object version (resourceVersion)
+    is unchanged. Invalid annotations fall back to the default and are
+    reported once per value instead of failing every evaluation.
+    """
+    def __init__(self, logger, name:str, defaults:AutoscalingConfigs, keyPrefix:str):
+        self.logger = logger
+        self.name = name
+        self.defaults = defaults
+        self.configs = defaults
+        self._keys = {annotation_key(keyPrefix, field): field for field in AutoscalingConfigs._fields}
+        self._raw = {} # annotation key -> value the current configs were parsed from
+        self._invalid = set() # (annotation key, value) already reported
+        self._version = None
+        self._logged = False
+
+    def resolve(self, annotations:dict, version:str=None) -> AutoscalingConfigs:
+        if version is not None and version == self._version:
+            return self.configs
+        self._version = version
+
+        changes = {}
+        for key, field in self._keys.items():
+            value = annotations.get(key)
+            if value == self._raw.get(key):
+                continue
+            if value is None:
+                del self._raw[key]
+                changes[field] = getattr(self.defaults, field)
+            else:
+                self._raw[key] = value
+                changes[field] = self._parse(key, field, value)
+        changed = {field: value for field, value in changes.items() if getattr(self.configs, field) != value}
+        self.configs = self.configs._replace(**changed)
+
+        if not self._logged:
+            self._logged = True
+            self.logger.info(f"{self.name} prometheus loaded with following autoscaling configs:")
+            for field, value in self.configs._asdict().items():
+                self.logger.info(f"\t {field.replace('_', '-')} = {value}")
+        elif changed:
+            self.logger.info(f"{self.name} prometheus autoscaling configs changed: " + ', '.join(f"{field.replace('_', '-')} = {value}" for field, value in changed.items()))
+        return self.configs
+
+    def _parse(self, key:str, field:str, value:str):
+        try:
+            return parse_value(field, value)
+        except Exception as e:
+            if (key, value) not in self._invalid:
+                self._invalid.add((key, value))
+                self.logger.error(f"ignoring invalid annotation {key}: '{value}' on {self.name} prometheus ({e}) - using default {getattr(self.defaults, field)}")
+            return getattr(self.defaults, field)
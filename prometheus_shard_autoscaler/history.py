@@ -0,0 +1,151 @@
+from array import array
+from bisect import bisect_left, insort
+from collections import deque
+from math import ceil
+
+class UsageHistory:
+    """
+    Sliding window of per-pod cpu/memory samples for a single Prometheus.
+
+    Samples live in array-backed ring buffers bounded by `capacity` and by
+    `window` seconds. Every statistic is maintained incrementally as samples
+    are added and evicted, so reading it never rescans the window:
+      - percentiles from sorted value lists (bisect insert/remove)
+      - window max from monotonic deques
+      - ewma of the per-update pod average
+      - least-squares trend of the per-update pod average/max memory, from
+        running sums over the window
+    """
+    def __init__(self, window:float=300, capacity:int=1024, ewmaAlpha:float=0.3):
+        self.window = window
+        self.capacity = capacity
+        self.ewmaAlpha = ewmaAlpha
+        self._timestamps = array('d')
+        self._cpu = array('d')
+        self._memory = array('d')
+        self._oldest = 0 # ring index of the oldest sample
+        self._size = 0
+        self._seq = 0 # sequence number of the next sample
+        self._sortedCpu = []
+        self._sortedMemory = []
+        self._maxCpu = deque() # (seq, value) with decreasing values
+        self._maxMemory = deque()
+        self._ewmaCpu = None
+        self._ewmaMemory = None
+        self._lastSeen = {} # pod name -> timestamp of its newest sample
+        self._updates = deque() # (time, avgMemory, maxMemory) per update that added samples
+        self._trendSums = [0.0] * 7 # n, sum(t), sum(t*t), sum(avg), sum(t*avg), sum(max), sum(t*max)
+        self._trendOrigin = None # times are relative to the first update to keep the sums precise
+        self.shards = None # shard count the samples were recorded with
+
+    def __len__(self):
+        return self._size
+
+    def configure(self, window:float, ewmaAlpha:float):
+        self.window = window
+        self.ewmaAlpha = ewmaAlpha
+
+    def clear(self, shards:int=None):
+        self.__init__(self.window, self.capacity, self.ewmaAlpha)
+        self.shards = shards
+
+    def restore(self, shards:int, ewmaCpu:float, ewmaMemory:float):
+        # seed the ewma from a persisted state (e.g. after an operator restart)
+        self.shards = shards
+        self._ewmaCpu = ewmaCpu; self._ewmaMemory = ewmaMemory
+
+    def add(self, samples:list, now:float) -> int:
+        # samples: [(podName, timestamp, cpu, memory)] - samples already seen for a pod are skipped
+        added = 0; sumCpu = 0.0; sumMemory = 0.0; maxMemory = 0.0
+        for pod, timestamp, cpu, memory in samples:
+            if timestamp <= self._lastSeen.get(pod, 0):
+                continue
+            self._lastSeen[pod] = timestamp
+            self._append(timestamp, float(cpu), float(memory))
+            added += 1; sumCpu += float(cpu); sumMemory += float(memory); maxMemory = max(maxMemory, float(memory))
+        self._lastSeen = {pod: self._lastSeen[pod] for pod, _, _, _ in samples if pod in self._lastSeen} # forget deleted pods
+
+        if added:
+            avgCpu = sumCpu / added; avgMemory = sumMemory / added
+            if self._ewmaCpu is None:
+                self._ewmaCpu = avgCpu; self._ewmaMemory = avgMemory
+            else:
+                self._ewmaCpu += self.ewmaAlpha * (avgCpu - self._ewmaCpu)
+                self._ewmaMemory += self.ewmaAlpha * (avgMemory - self._ewmaMemory)
+            if self._trendOrigin is None:
+                self._trendOrigin = now
+            update = (now - self._trendOrigin, avgMemory, maxMemory)
+            self._updates.append(update)
+            self._update_trend(update, 1)
+
+        self.evict(now)
+        return added
+
+    def evict(self, now:float):
+        while self._size and self._timestamps[self._oldest] < now - self.window:
+            self._pop_oldest()
+        while self._updates and self._updates[0][0] < now - self._trendOrigin - self.window:
+            self._update_trend(self._updates.popleft(), -1)
+
+    def project(self, at:float, kind:str='avg', minUpdates:int=3) -> float:
+        # memory projected at time `at` by the least-squares trend of the per-update avg (or max) pod memory
+        n, st, stt, sa, sta, sm, stm = self._trendSums
+        if n < minUpdates:
+            return None
+        sy, sty = (sa, sta) if kind == 'avg' else (sm, stm)
+        denominator = n * stt - st * st
+        if denominator <= 0: # all updates at the same time
+            return sy / n
+        slope = (n * sty - st * sy) / denominator
+        intercept = (sy - slope * st) / n
+        return intercept + slope * (at - self._trendOrigin)
+
+    def percentile(self, q:float) -> dict:
+        if not self._size:
+            return {'cpu': 0, 'memory': 0}
+        rank = max(ceil(q * self._size) - 1, 0) # nearest-rank
+        return {'cpu': self._sortedCpu[rank], 'memory': self._sortedMemory[rank]}
+
+    def max(self) -> dict:
+        if not self._size:
+            return {'cpu': 0, 'memory': 0}
+        return {'cpu': self._maxCpu[0][1], 'memory': self._maxMemory[0][1]}
+
+    def ewma(self) -> dict:
+        if self._ewmaCpu is None:
+            return {'cpu': 0, 'memory': 0}
+        return {'cpu': self._ewmaCpu, 'memory': self._ewmaMemory}
+
+    def _update_trend(self, update:tuple, sign:int):
+        t, avgMemory, maxMemory = update
+        for i, value in enumerate((1, t, t * t, avgMemory, t * avgMemory, maxMemory, t * maxMemory)):
+            self._trendSums[i] += sign * value
+
+    def _append(self, timestamp:float, cpu:float, memory:float):
+        if self._size == self.capacity:
+            self._pop_oldest()
+        if len(self._timestamps) < self.capacity: # grow until capacity is reached
+            self._timestamps.append(timestamp); self._cpu.append(cpu); self._memory.append(memory)
+        else:
+            i = (self._oldest + self._size) % self.capacity
+            self._timestamps[i] = timestamp; self._cpu[i] = cpu; self._memory[i] = memory
+        self._size += 1
+
+        insort(self._sortedCpu, cpu)
+        insort(self._sortedMemory, memory)
+        for maxDeque, value in ((self._maxCpu, cpu), (self._maxMemory, memory)):
+            while maxDeque and maxDeque[-1][1] <= value:
+                maxDeque.pop()
+            maxDeque.append((self._seq, value))
+        self._seq += 1
+
+    def _pop_oldest(self):
+        cpu = self._cpu[self._oldest]; memory = self._memory[self._oldest]
+        del self._sortedCpu[bisect_left(self._sortedCpu, cpu)]
+        del self._sortedMemory[bisect_left(self._sortedMemory, memory)]
+        seq = self._seq - self._size
+        for maxDeque in (self._maxCpu, self._maxMemory):
+            if maxDeque and maxDeque[0][0] == seq:
+                maxDeque.popleft()
+        self._oldest = (self._oldest + 1) % self.capacity
+        self._size -= 1
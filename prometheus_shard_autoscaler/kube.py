@@ -1,100 +1,299 @@
+import asyncio
 from decimal import Decimal
+from functools import partial
+import json
 from math import ceil
+import time
+from history import UsageHistory
+from signals import ShardMetricsScraper
+from usage import PodUsage
+import telemetry
 import utils
 from kubernetes import client, config
-from datetime import datetime
+from kubernetes.client.rest import ApiException
+from urllib3.util.retry import Retry
 
 PROM_OPERATOR_LABEL_PREFIX="operator.prometheus.io"
+MEBIBYTE = 1024 * 1024 # granularity of memory requests set by algorithm 'joint'
+LEASE_CRD = {
+    'group': "coordination.k8s.io",
+    'version': "v1",
+    'plural': "leases"
+}
+
+class PodMetricsCache:
+    """
+    Process-wide cache of metrics.k8s.io pod metrics for prometheus pods.
+    A single LIST is issued per namespace (or for the whole cluster) and the
+    results are indexed by (namespace, operator.prometheus.io/name) so every
+    autoscaled Prometheus reads its pods from memory.
+
+    Entries expire when metrics-server is expected to have a newer sample:
+    newest pod `timestamp` + resolution, bounded to [minTtl, resolution]
+    seconds from the time of the fetch.
+
+    When `recordFile` is set every fetched list is appended to it as a JSON
+    line, which can be replayed with simulator.py.
+    """
+    def __init__(self, scope:str='namespace', resolution:int=15, minTtl:int=5, recordFile:str=None):
+        if scope not in ('namespace', 'cluster'):
+            raise Exception(f"provided metrics cache scope, {scope}, must be 'namespace' or 'cluster'")
+        self.scope = scope
+        self.resolution = resolution
+        self.minTtl = minTtl
+        self.recordFile = recordFile
+        self._entries = {} # namespace (or None for cluster scope) -> (expiresAt, {(namespace, name): [podMetrics]})
+        self._locks = {}
+
+    async def get(self, kubeclient, name:str, namespace:str) -> list:
+        key = namespace if self.scope == 'namespace' else None
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            async with lock: # coalesce concurrent refreshes of the same entry into one LIST
+                entry = self._entries.get(key)
+                if entry is None or entry[0] <= time.time():
+                    entry = await self.refresh(kubeclient, key)
+        return entry[1].get((namespace, name), [])
+
+    async def refresh(self, kubeclient, namespace:str=None):
+        labelSelector = f"{PROM_OPERATOR_LABEL_PREFIX}/name"
+        if namespace is None:
+            LOGGER.debug("refreshing pod metrics cache for all namespaces")
+        else:
+            LOGGER.debug(f"refreshing pod metrics cache for namespace {namespace}")
+        metricList = await kubeclient.list_pod_metrics(namespace, labelSelector)
+
+        index = {}; newest = 0
+        for pod in metricList['items']:
+            metadata = pod['metadata']
+            key = (metadata['namespace'], metadata['labels'][labelSelector])
+            index.setdefault(key, []).append(pod)
+            if pod.get('timestamp'):
+                newest = max(newest, utils.parse_timestamp(pod['timestamp']))
+
+        now = time.time()
+        if self.recordFile:
+            with open(self.recordFile, 'a') as record:
+                record.write(json.dumps({'time': now, 'items': metricList['items']}) + "\n")
+        expiresAt = min(max(newest + self.resolution, now + self.minTtl), now + self.resolution)
+        entry = (expiresAt, index)
+        self._entries[namespace] = entry
+        return entry
 
 class KubeClient:
-    def __init__(self, logger, kubeconfig = None):
+    def __init__(self, logger, kubeconfig = None, metricsCache = None, executor = None, 
+        leaseExecutor = None,
+        requestTimeout:float = 10,
+        connectTimeout:float = 3,
+        poolMaxsize:int = 8,
+        retries:int = 3,
+        retryBackoff:float = 0.5,
+        metricsMaxAge:float = 120,
+        dryRun:bool = False
+    ):
+        # one Configuration/ApiClient per process so all daemons share the same keep-alive connection pool
+        configuration = client.Configuration()
         try:
             if not kubeconfig:
-                config.load_incluster_config()
+                config.load_incluster_config(client_configuration=configuration)
             else:
-                config.load_kube_config(kubeconfig)
+                config.load_kube_config(kubeconfig, client_configuration=configuration)
         except config.ConfigException:
-            config.load_kube_config()
+            config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = poolMaxsize # keep at least one pooled connection per executor thread
+        configuration.retries = Retry(
+            total=retries, 
+            backoff_factor=retryBackoff, 
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=False # the backoff spaces the retries - a Retry-After could outlast callTimeout
+        )
         
-        self.clientCustomObjectsApi = client.CustomObjectsApi()
+        apiClient = client.ApiClient(configuration)
+        self.clientCustomObjectsApi = client.CustomObjectsApi(apiClient)
+        self.clientCoreV1Api = client.CoreV1Api(apiClient)
+        self.metricsCache = metricsCache
+        self.executor = executor # None uses the event loop's default executor
+        self.leaseExecutor = leaseExecutor # membership leases, so renewals never queue behind slow api calls (None uses executor)
+        self.requestTimeout = requestTimeout
+        self.connectTimeout = connectTimeout
+        # the retries run inside the executor call - wait for every attempt and backoff (urllib3 doesn't back off before the
+        # first retry), plus a margin so the call gives up on its own timeouts instead of leaving its thread running
+        backoff = sum(min(retryBackoff * 2 ** (n - 1), Retry.DEFAULT_BACKOFF_MAX) for n in range(2, retries + 1))
+        self.callTimeout = (retries + 1) * (connectTimeout + requestTimeout) + backoff + connectTimeout
+        self.metricsMaxAge = metricsMaxAge
+        self.dryRun = dryRun # log patches of Prometheus objects instead of sending them
+        self._podUsage = {} # (namespace, name) -> (pod metrics list, PodUsage) of the last aggregation
         global LOGGER
         LOGGER = logger
             
-    def prom_pod_usage(self, name:str, namespace:str, usageCalculator:str):
-        def prom_pod_usage_avg():
-            LOGGER.debug(f"calculating current resource usage for {name} prometheus")
-            sumCpu = 0; sumMemory = 0; availablePodCount = 0
-            metricList = self.clientCustomObjectsApi.list_namespaced_custom_object(
-                group = 'metrics.k8s.io', 
-                version = 'v1beta1', 
-                plural = 'pods',
-                namespace=namespace,
-                field_selector = f"metadata.namespace={namespace}",
-                label_selector = f"{PROM_OPERATOR_LABEL_PREFIX}/name={name}"
+    async def call_api(self, apiCall:str, method, executor = None, **kwargs):
+        # run blocking kubernetes client calls in the executor so a slow api response never stalls the event loop
+        loop = asyncio.get_running_loop()
+        start = time.monotonic(); outcome = 'error'
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(executor or self.executor, partial(method, _request_timeout=(self.connectTimeout, self.requestTimeout), **kwargs)),
+                timeout=self.callTimeout
             )
+            outcome = 'success'
+            return result
+        finally:
+            telemetry.API_CALL_LATENCY.labels(call=apiCall).observe(time.monotonic() - start)
+            telemetry.API_CALLS.labels(call=apiCall, outcome=outcome).inc()
 
-            for pod in metricList['items']:
-                cpu = 0; memory = 0
-                for container in pod['containers']:
-                    usage = container['usage']
-                    cpu += utils.parse_quantity(usage['cpu'])
-                    memory += utils.parse_quantity(usage['memory'])
-                if cpu != 0 and memory != 0: # ignore pods that show 0 usage (maybe cause they're pending/scheduling)
-                    availablePodCount += 1
-                    sumCpu += cpu
-                    sumMemory += memory
-            
-            # calculate average usage
-            if availablePodCount == 0:
-                return {'cpu': 0, 'memory': 0}
-            else:
-                avgCpu = sumCpu / availablePodCount
-                avgCpu = sumMemory / availablePodCount
-                return {'cpu': avgCpu, 'memory': avgCpu}
-            
-        def prom_pod_usage_max():
-            LOGGER.debug(f"calculating current resource usage for {name} prometheus")
-            maxCpu = 0; maxMemory = 0
-            metricList = self.clientCustomObjectsApi.list_namespaced_custom_object(
+    async def list_pod_metrics(self, namespace:str=None, labelSelector:str=None) -> dict:
+        if namespace is None:
+            return await self.call_api('list_pod_metrics', self.clientCustomObjectsApi.list_cluster_custom_object,
                 group = 'metrics.k8s.io', 
                 version = 'v1beta1', 
                 plural = 'pods',
-                namespace=namespace,
-                field_selector = f"metadata.namespace={namespace}",
-                label_selector = f"{PROM_OPERATOR_LABEL_PREFIX}/name={name}"
+                label_selector = labelSelector
             )
+        return await self.call_api('list_pod_metrics', self.clientCustomObjectsApi.list_namespaced_custom_object,
+            group = 'metrics.k8s.io', 
+            version = 'v1beta1', 
+            plural = 'pods',
+            namespace=namespace,
+            label_selector = labelSelector
+        )
+
+    async def list_proms(self, promCrd:dict) -> list:
+        response = await self.call_api('list_proms', self.clientCustomObjectsApi.list_cluster_custom_object,
+            group = promCrd['group'], 
+            version = promCrd['version'], 
+            plural = promCrd['plural']
+        )
+        return response['items']
+
+    async def list_pods(self, labelSelector:str) -> dict:
+        # raw json (dicts, like kopf bodies) - pods aren't deserialized to client models
+        def list_pods_json(**kwargs) -> dict:
+            # the body is read and decoded in the executor too, within the call timeout
+            response = self.clientCoreV1Api.list_pod_for_all_namespaces(_preload_content=False, **kwargs)
+            try:
+                return json.loads(response.data)
+            finally:
+                response.release_conn()
+        return await self.call_api('list_pods', list_pods_json,
+            label_selector = labelSelector
+        )
+
+    def watch_pods(self, labelSelector:str, resourceVersion:str, timeoutSeconds:int):
+        # blocking generator of raw json watch events - must run outside the event loop
+        response = self.clientCoreV1Api.list_pod_for_all_namespaces(
+            label_selector = labelSelector,
+            resource_version = resourceVersion,
+            watch = True,
+            allow_watch_bookmarks = True,
+            timeout_seconds = timeoutSeconds,
+            _preload_content = False,
+            _request_timeout = (self.connectTimeout, timeoutSeconds + self.requestTimeout)
+        )
+        telemetry.API_CALLS.labels(call='watch_pods', outcome='success').inc()
+        try:
+            buffer = b''
+            for chunk in response.stream(decode_content=True):
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            response.release_conn()
+
+    async def list_prom_pod_metrics(self, name:str, namespace:str) -> list:
+        start = time.monotonic()
+        try:
+            if self.metricsCache is not None:
+                return await self.metricsCache.get(self, name, namespace)
+            metricList = await self.list_pod_metrics(namespace, f"{PROM_OPERATOR_LABEL_PREFIX}/name={name}")
+            return metricList['items']
+        finally:
+            telemetry.EVALUATION_PHASE_LATENCY.labels(phase='fetch').observe(time.monotonic() - start)
+
+    async def aggregate_pod_usage(self, name:str, namespace:str, expectedPods:int=None) -> PodUsage:
+        # one aggregation per fetched metrics list - shared by the usage calculators and the usage history
+        podMetrics = await self.list_prom_pod_metrics(name, namespace)
+        cached = self._podUsage.get((namespace, name))
+        if cached is not None and cached[0] is podMetrics:
+            return cached[1]
+        usage = PodUsage.aggregate(podMetrics, utils.now(), self.metricsMaxAge, expectedPods, f"{PROM_OPERATOR_LABEL_PREFIX}/shard")
+        self._podUsage[(namespace, name)] = (podMetrics, usage)
+        skew = usage.skew()
+        LOGGER.debug(f"{name} prometheus has shard skew {skew:.2f} across {len(usage.shards)} shard(s)")
+        telemetry.SHARD_SKEW.labels(namespace, name).set(float(skew))
+        for reason in ('pending', 'stale', 'missing'):
+            count = getattr(usage, reason)
+            if count:
+                LOGGER.debug(f"excluding {count} {reason} pod(s) from {name} prometheus usage")
+                telemetry.EXCLUDED_PODS.labels(namespace, name, reason).inc(count)
+        return usage
+
+    def forget_pod_usage(self, name:str, namespace:str):
+        self._podUsage.pop((namespace, name), None)
+
+    async def record_pod_usage(self, name:str, namespace:str, history:UsageHistory, expectedPods:int=None):
+        LOGGER.debug(f"recording resource usage samples for {name} prometheus")
+        usage = await self.aggregate_pod_usage(name, namespace, expectedPods)
+        history.add(usage.samples, utils.now())
+
+    async def prom_pod_usage(self, name:str, namespace:str, usageCalculator:str, history:UsageHistory=None, expectedPods:int=None, skewPolicy:str='none'):
+        async def prom_pod_usage_window():
+            await self.record_pod_usage(name, namespace, history, expectedPods)
             
-            for pod in metricList['items']:
-                cpu = 0; memory = 0;
-                for container in pod['containers']:
-                    usage = container['usage']
-                    cpu += utils.parse_quantity(usage['cpu'])
-                    memory += utils.parse_quantity(usage['memory'])
-                maxCpu = max(maxCpu, cpu)
-                maxMemory = max(maxMemory, memory)
-            
-            return {'cpu': maxCpu, 'memory': maxMemory}
+            if usageCalculator == 'p95':
+                usage = history.percentile(0.95)
+            elif usageCalculator == 'ewma':
+                usage = history.ewma()
+            else:
+                usage = history.max()
+            return {'cpu': Decimal(str(usage['cpu'])), 'memory': Decimal(str(usage['memory']))}
         
-        if usageCalculator == 'max':
-            return prom_pod_usage_max()
+        if usageCalculator in ('avg', 'max') and skewPolicy == 'median':
+            LOGGER.debug(f"calculating current resource usage of the median shard for {name} prometheus")
+            return (await self.aggregate_pod_usage(name, namespace, expectedPods)).median()
+        elif usageCalculator == 'max':
+            LOGGER.debug(f"calculating current resource usage for {name} prometheus")
+            return (await self.aggregate_pod_usage(name, namespace, expectedPods)).max()
         elif usageCalculator == 'avg':
-            return prom_pod_usage_avg()
+            LOGGER.debug(f"calculating current resource usage for {name} prometheus")
+            return (await self.aggregate_pod_usage(name, namespace, expectedPods)).avg()
+        elif usageCalculator in ('p95', 'ewma', 'max-over-window'):
+            if history is None:
+                raise Exception(f"usageCalculator {usageCalculator} requires a usage history")
+            return await prom_pod_usage_window()
         else:
-            raise Exception(f"provided usageCalculator, {usageCalculator}, must be 'max' or 'avg'")
+            raise Exception(f"provided usageCalculator, {usageCalculator}, must be 'max', 'avg', 'p95', 'ewma' or 'max-over-window'")
 
-    def calculate_desired_shards(self, name:str, namespace:str, spec, 
+    async def calculate_desired_shards(self, name:str, namespace:str, spec, 
         minShards:int, maxShards:int, 
         disableScaleDown:bool=False,
         algorithm:str='double-or-decrement', 
         usageCalculator:str='avg', 
+        skewPolicy:str='none', # 'median' sizes the avg/max usage on the median shard
+        history:UsageHistory = None,
         targetUtil:Decimal = 1.0, 
         targetUtilScaleUp:Decimal = 0.75, # only used for algorithm='thresholds'
         targetUtilScaleDown:Decimal = 0.25,  # only used for algorithm='thresholds'
         minDecrement:int=0, # 0 means disable
         minIncrement:int=0, # 0 means disable
         maxDecrement:int=0, # 0 means disable
-        maxIncrement:int=0  # 0 means disable
+        maxIncrement:int=0, # 0 means disable
+        leadTime:int=300, # only used for algorithm='predictive'
+        signals:list=('memory',), # only used for algorithm='multi-signal'
+        targetCpuUtil:Decimal = 0.75, # only used for algorithm='multi-signal'
+        targetHeadSeries:int = 0, # only used for algorithm='multi-signal' - per shard, 0 means disable
+        targetSamplesRate:int = 0, # only used for algorithm='multi-signal' - per shard, 0 means disable
+        shardMetrics:ShardMetricsScraper = None # only used for algorithm='multi-signal'
     ) -> int:
+        expectedPods = spec['shards'] * (spec.get('replicas') or 1)
+
+        def observe_memory_util(memCurr):
+            memRequest = spec.get('resources', {}).get('requests', {}).get('memory')
+            if memRequest:
+                telemetry.MEMORY_UTIL.labels(namespace, name).set(float(memCurr / utils.parse_bytes(memRequest)))
+
         def enforce_thresholds(desiredShards) -> int:
             # enforce configured thresholds for min/max step-up and step-down
             step = desiredShards - spec['shards']
@@ -124,45 +323,47 @@ class KubeClient:
                 LOGGER.debug(f"calculated desiredShards is less than minShards ({minShards}) - updating to satisfy minShards")
                 desiredShards = minShards
             
-            LOGGER.info(f"desiredShards for {name} prometheus is {desiredShards}")
+            LOGGER.debug(f"desiredShards for {name} prometheus is {desiredShards}")
             return desiredShards
         
-        def desired_shards_hpa() -> int:
-            LOGGER.info(f"{name} prometheus has current shards: {spec['shards']}")
+        async def desired_shards_hpa() -> int:
+            LOGGER.debug(f"{name} prometheus has current shards: {spec['shards']}")
             
             # GET CURRENT USAGE
-            usage = self.prom_pod_usage(name, namespace, usageCalculator)
+            usage = await self.prom_pod_usage(name, namespace, usageCalculator, history, expectedPods, skewPolicy)
             memCurr = usage['memory']
             if memCurr == 0: # dont produce downscale if memCurr is 0
                 LOGGER.warning("current memory usage returned 0 bytes! - is metrics api available?")
-                LOGGER.info("setting desired to current")
+                LOGGER.debug("setting desired to current")
                 return spec['shards']
             
-            LOGGER.info(f"{name} prometheus has current memory: {utils.sizeof_fmt(memCurr)}")
+            LOGGER.debug(f"{name} prometheus has current memory: {utils.sizeof_fmt(memCurr)}")
+            observe_memory_util(memCurr)
 
             # GET TARGET MEMORY
-            memTarget = utils.parse_quantity(spec['resources']['requests']['memory']) * targetUtil
-            LOGGER.info(f"{name} prometheus has target memory: {utils.sizeof_fmt(memTarget)}")
+            memTarget = Decimal(utils.parse_bytes(spec['resources']['requests']['memory'])) * targetUtil
+            LOGGER.debug(f"{name} prometheus has target memory: {utils.sizeof_fmt(memTarget)}")
 
             desiredShards = ceil(spec['shards'] * ( memCurr / memTarget )) # using traditional HPA algorithm
             
             # return after enforcing threshold settings
             return enforce_thresholds(desiredShards)
         
-        def desired_shards_double_or_decrement() -> int:
-            LOGGER.info(f"{name} prometheus has current shards: {spec['shards']}")
+        async def desired_shards_double_or_decrement() -> int:
+            LOGGER.debug(f"{name} prometheus has current shards: {spec['shards']}")
             
             # GET CURRENT USAGE
-            usage = self.prom_pod_usage(name, namespace, usageCalculator)
+            usage = await self.prom_pod_usage(name, namespace, usageCalculator, history, expectedPods, skewPolicy)
             memCurr = usage['memory']
             if memCurr == 0: # dont produce downscale if memCurr is 0
                 LOGGER.warning("current memory usage returned 0 bytes! - is metrics api available?")
-                LOGGER.info("setting desired to current")
+                LOGGER.debug("setting desired to current")
                 return spec['shards']
             
-            memTarget = utils.parse_quantity(spec['resources']['requests']['memory']) 
+            memTarget = Decimal(utils.parse_bytes(spec['resources']['requests']['memory'])) 
             memCurrUtil = (memCurr / memTarget)
-            LOGGER.info(f"{name} prometheus has current memory util {memCurrUtil:.3f}")
+            LOGGER.debug(f"{name} prometheus has current memory util {memCurrUtil:.3f}")
+            telemetry.MEMORY_UTIL.labels(namespace, name).set(float(memCurrUtil))
 
             if memCurrUtil > targetUtilScaleUp: # double shards
                 LOGGER.debug(f"{name} memory util is greater than target for scale-up ({targetUtilScaleUp:.3f}) - desired is double current value")
@@ -176,50 +377,240 @@ class KubeClient:
             # return after enforcing threshold settings
             return enforce_thresholds(desiredShards)
         
+        async def desired_shards_predictive() -> int:
+            LOGGER.debug(f"{name} prometheus has current shards: {spec['shards']}")
+            if history is None:
+                raise Exception(f"algorithm predictive requires a usage history")
+            
+            # GET CURRENT USAGE (recording samples for the trend)
+            if usageCalculator in ('avg', 'max'):
+                await self.record_pod_usage(name, namespace, history, expectedPods)
+            usage = await self.prom_pod_usage(name, namespace, usageCalculator, history, expectedPods, skewPolicy)
+            memCurr = usage['memory']
+            if memCurr == 0: # dont produce downscale if memCurr is 0
+                LOGGER.warning("current memory usage returned 0 bytes! - is metrics api available?")
+                LOGGER.debug("setting desired to current")
+                return spec['shards']
+            
+            # PROJECT MEMORY AT NOW + LEAD TIME (new shard startup + WAL replay)
+            trend = 'avg' if usageCalculator in ('avg', 'ewma') else 'max'
+            memProjected = history.project(utils.now() + leadTime, trend)
+            if memProjected is None:
+                LOGGER.debug(f"not enough usage history to project {name} prometheus memory - using current memory")
+                memProjected = memCurr
+            else:
+                memProjected = max(memCurr, Decimal(str(memProjected))) # a falling trend never scales down below current usage
+            observe_memory_util(memCurr)
+            LOGGER.debug(f"{name} prometheus has current memory: {utils.sizeof_fmt(memCurr)}, projected in {leadTime}s: {utils.sizeof_fmt(memProjected)}")
+
+            # GET TARGET MEMORY
+            memTarget = Decimal(utils.parse_bytes(spec['resources']['requests']['memory'])) * targetUtil
+            LOGGER.debug(f"{name} prometheus has target memory: {utils.sizeof_fmt(memTarget)}")
+
+            desiredShards = ceil(spec['shards'] * ( memProjected / memTarget )) # HPA algorithm on projected memory
+            
+            # return after enforcing threshold settings
+            return enforce_thresholds(desiredShards)
+        
+        async def desired_shards_multi_signal() -> int:
+            LOGGER.debug(f"{name} prometheus has current shards: {spec['shards']}")
+            desiredBySignal = {}
+
+            # HPA algorithm per signal: desired = ceil(currShards * ( curr / target ))
+            if 'memory' in signals or 'cpu' in signals:
+                usage = await self.prom_pod_usage(name, namespace, usageCalculator, history, expectedPods, skewPolicy)
+                resourceRequests = spec.get('resources', {}).get('requests', {})
+                if 'memory' in signals and usage['memory'] != 0 and 'memory' in resourceRequests:
+                    memTarget = Decimal(utils.parse_bytes(resourceRequests['memory'])) * targetUtil
+                    observe_memory_util(usage['memory'])
+                    LOGGER.debug(f"{name} prometheus has current memory: {utils.sizeof_fmt(usage['memory'])}, target: {utils.sizeof_fmt(memTarget)}")
+                    desiredBySignal['memory'] = ceil(spec['shards'] * ( usage['memory'] / memTarget ))
+                if 'cpu' in signals and usage['cpu'] != 0 and 'cpu' in resourceRequests:
+                    cpuTarget = Decimal(utils.parse_nanocores(resourceRequests['cpu'])) / utils.NANOCORES * targetCpuUtil
+                    LOGGER.debug(f"{name} prometheus has current cpu: {usage['cpu']:.3f}, target: {cpuTarget:.3f}")
+                    desiredBySignal['cpu'] = ceil(spec['shards'] * ( usage['cpu'] / cpuTarget ))
+
+            if ('head-series' in signals and targetHeadSeries > 0) or ('samples-rate' in signals and targetSamplesRate > 0):
+                if shardMetrics is None:
+                    raise Exception(f"signals head-series and samples-rate require a shard metrics scraper")
+                podMetrics = await shardMetrics.scrape()
+                aggregate = (lambda values: sum(values) / len(values)) if usageCalculator == 'avg' else max
+                for signal, target in (('head-series', targetHeadSeries), ('samples-rate', targetSamplesRate)):
+                    values = [m[signal] for m in podMetrics if m[signal] is not None]
+                    if signal in signals and target > 0 and values:
+                        current = aggregate(values)
+                        LOGGER.debug(f"{name} prometheus has current {signal} per shard: {current:.0f}, target: {target}")
+                        desiredBySignal[signal] = ceil(spec['shards'] * ( current / target ))
+
+            if not desiredBySignal: # dont produce downscale if no signal is available
+                LOGGER.warning(f"no scaling signal ({', '.join(signals)}) available for {name} prometheus - is metrics api available?")
+                LOGGER.debug("setting desired to current")
+                return spec['shards']
+            
+            LOGGER.debug(f"{name} prometheus desiredShards by signal: {desiredBySignal}")
+            desiredShards = max(desiredBySignal.values())
+
+            # return after enforcing threshold settings
+            return enforce_thresholds(desiredShards)
+
         if algorithm == 'hpa':
             LOGGER.debug(f"calculating desiredShards with algorithm=hpa")
-            return desired_shards_hpa()
+            return await desired_shards_hpa()
+        elif algorithm == 'multi-signal':
+            LOGGER.debug(f"calculating desiredShards with algorithm=multi-signal")
+            return await desired_shards_multi_signal()
+        elif algorithm == 'predictive':
+            LOGGER.debug(f"calculating desiredShards with algorithm=predictive")
+            return await desired_shards_predictive()
         elif algorithm == 'double-or-decrement':
             LOGGER.debug(f"calculating desiredShards with algorithm=double-or-decrement")
-            return desired_shards_double_or_decrement()
+            return await desired_shards_double_or_decrement()
         else:
-            raise Exception(f"provided algorithm, {algorithm}, must be 'hpa' or 'double-or-decrement'")
+            raise Exception(f"provided algorithm, {algorithm}, must be 'hpa', 'double-or-decrement', 'predictive' or 'multi-signal'")
     
-    def scale_prom_shards(self, name:str, namespace:str, promCrd:dict, desiredShards:int, annotationKey:str):
-        LOGGER.info(f"patching {name} prometheus shards to {desiredShards}")
-        body = {
-            'metadata': {
-                'annotations': {
-                    f"{annotationKey}": str(datetime.now().timestamp())
-                }
-            },
-            'spec': {
-                'shards': desiredShards
-            }
-        }
-        self.clientCustomObjectsApi.patch_namespaced_custom_object(
-            group = promCrd['group'], 
-            version = promCrd['version'], 
-            plural = promCrd['plural'], 
-            namespace=namespace, 
-            name = name, 
-            body = body
-        )
+    async def calculate_desired_sizing(self, name:str, namespace:str, spec, 
+        minShards:int, maxShards:int, 
+        minRequest:int, maxRequest:int,
+        disableScaleDown:bool=False,
+        usageCalculator:str='avg', 
+        skewPolicy:str='none',
+        history:UsageHistory = None,
+        targetUtil:Decimal = 1.0,
+        tolerance:Decimal = Decimal('0.1'), # relative deviation from targetUtil tolerated before changing the memory request
+        prevDesired:tuple = (0, 0) # (shards, memory request) desired by the previous evaluation
+    ) -> tuple:
+        # desired (shards, memory request bytes) minimising the total reserved memory while usage stays under targetUtil
+        LOGGER.debug(f"{name} prometheus has current shards: {spec['shards']}")
+        expectedPods = spec['shards'] * (spec.get('replicas') or 1)
+        currRequest = utils.parse_bytes(spec['resources']['requests']['memory'])
 
-    def add_timestamp_annotation(self, name:str, namespace:str, promCrd:dict, annotationKey:str):
-        LOGGER.info(f"patching {name} prometheus with current timestamp annotation")
-        body = {
-            'metadata': {
-                'annotations': {
-                    f"{annotationKey}": str(datetime.now().timestamp())
-                }
-            }
-        }
-        self.clientCustomObjectsApi.patch_namespaced_custom_object(
-            group = promCrd['group'], 
-            version = promCrd['version'], 
-            plural = promCrd['plural'], 
-            namespace=namespace, 
-            name = name, 
-            body = body
+        # GET CURRENT USAGE (recording samples for the window peak)
+        if history is not None and usageCalculator in ('avg', 'max'):
+            await self.record_pod_usage(name, namespace, history, expectedPods)
+        usage = await self.prom_pod_usage(name, namespace, usageCalculator, history, expectedPods, skewPolicy)
+        memCurr = usage['memory']
+        if memCurr == 0: # dont produce downscale if memCurr is 0
+            LOGGER.warning("current memory usage returned 0 bytes! - is metrics api available?")
+            LOGGER.debug("setting desired to current")
+            return spec['shards'], currRequest
+        telemetry.MEMORY_UTIL.labels(namespace, name).set(float(memCurr / currRequest))
+        if history is not None: # the request has to hold the peak pod of the usage window, not the sample this evaluation landed on
+            memCurr = max(memCurr, Decimal(str(history.max()['memory'])))
+
+        # reserved memory is shards * request >= memTotal / targetUtil for every shard count, until the request hits minRequest -
+        # so the fewest shards whose request fits under maxRequest reserve the least memory
+        memTotal = memCurr * spec['shards'] # the replicas of a shard hold the same series
+        desiredShards = min(max(ceil(memTotal / (maxRequest * targetUtil)), minShards), maxShards)
+        memPerShard = memTotal / desiredShards
+        def fits(request) -> bool:
+            # a request is resized as soon as usage goes over the target, and kept while it stays under by at most 2 x tolerance -
+            # new requests are sized tolerance under the target, so usage can move by tolerance either way before the next resize
+            return 1 - 2 * tolerance <= memPerShard / request / targetUtil <= 1
+        if desiredShards == spec['shards'] and fits(currRequest):
+            desiredRequest = currRequest # a new request restarts every pod - not worth it for small deviations
+        else:
+            desiredRequest = ceil(memPerShard / (targetUtil * (1 - tolerance)) / MEBIBYTE) * MEBIBYTE # middle of the tolerated band
+            prevShards, prevRequest = prevDesired
+            if desiredShards == prevShards and prevRequest and fits(prevRequest):
+                desiredRequest = prevRequest # keep the previous desired request while usage drifts - so min-warmup-* can elapse
+            if memPerShard / targetUtil > maxRequest: # only the headroom is capped otherwise
+                LOGGER.warning(f"{name} prometheus needs {utils.sizeof_fmt(memPerShard / targetUtil)} per shard at max shards ({maxShards}) - capping to {utils.sizeof_fmt(maxRequest)}")
+            desiredRequest = max(min(desiredRequest, maxRequest), minRequest)
+        LOGGER.debug(f"{name} prometheus has total memory: {utils.sizeof_fmt(memTotal)}, desired {desiredShards} shards x {utils.sizeof_fmt(desiredRequest)}")
+
+        if disableScaleDown and desiredShards * desiredRequest < spec['shards'] * currRequest:
+            LOGGER.debug(f"calculated sizing reserves less memory than current but scale-down is disabled - setting to current spec")
+            return spec['shards'], currRequest
+        return desiredShards, desiredRequest
+
+    async def patch_prom(self, name:str, namespace:str, promCrd:dict, 
+        shards:int = None, 
+        annotations:dict = None, 
+        resourceVersion:str = None,
+        resources:dict = None
+    ) -> bool:
+        # single merge patch of the shards, resources and annotations of an evaluation - returns False when the object changed concurrently
+        body = {'metadata': {}}
+        if annotations:
+            body['metadata']['annotations'] = annotations
+        if resourceVersion is not None:
+            body['metadata']['resourceVersion'] = resourceVersion # precondition - the api server rejects the patch with 409 Conflict when stale
+        if shards is not None:
+            body['spec'] = {'shards': shards}
+        if resources:
+            body.setdefault('spec', {})['resources'] = resources
+        
+        if self.dryRun:
+            log = LOGGER.info if shards is not None or resources else LOGGER.debug
+            log(f"dry-run: not patching {name} prometheus with {json.dumps(body)}")
+            return True
+        if resources:
+            LOGGER.info(f"patching {name} prometheus shards to {shards} and resources to {resources}")
+        elif shards is not None:
+            LOGGER.info(f"patching {name} prometheus shards to {shards}")
+        else:
+            LOGGER.debug(f"patching {name} prometheus annotations {list(annotations or {})}")
+        try:
+            await self.call_api('patch_prometheus', self.clientCustomObjectsApi.patch_namespaced_custom_object,
+                group = promCrd['group'], 
+                version = promCrd['version'], 
+                plural = promCrd['plural'], 
+                namespace=namespace, 
+                name = name, 
+                body = body
+            )
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            LOGGER.warning(f"{name} prometheus was modified since resourceVersion {resourceVersion} - patch skipped until the next evaluation")
+            return False
+        return True
+
+    async def list_leases(self, namespace:str, labelSelector:str) -> list:
+        leaseList = await self.call_api('list_leases', self.clientCustomObjectsApi.list_namespaced_custom_object,
+            executor = self.leaseExecutor,
+            group = LEASE_CRD['group'], 
+            version = LEASE_CRD['version'], 
+            plural = LEASE_CRD['plural'], 
+            namespace=namespace,
+            label_selector = labelSelector
         )
+        return leaseList['items']
+
+    async def apply_lease(self, name:str, namespace:str, body:dict):
+        # merge patch the lease, creating it when it doesn't exist yet
+        try:
+            await self.call_api('patch_lease', self.clientCustomObjectsApi.patch_namespaced_custom_object,
+                executor = self.leaseExecutor,
+                group = LEASE_CRD['group'], 
+                version = LEASE_CRD['version'], 
+                plural = LEASE_CRD['plural'], 
+                namespace=namespace, 
+                name = name, 
+                body = body
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            await self.call_api('create_lease', self.clientCustomObjectsApi.create_namespaced_custom_object,
+                executor = self.leaseExecutor,
+                group = LEASE_CRD['group'], 
+                version = LEASE_CRD['version'], 
+                plural = LEASE_CRD['plural'], 
+                namespace=namespace, 
+                body = {'apiVersion': f"{LEASE_CRD['group']}/{LEASE_CRD['version']}", 'kind': 'Lease', **body}
+            )
+
+    async def delete_lease(self, name:str, namespace:str):
+        try:
+            await self.call_api('delete_lease', self.clientCustomObjectsApi.delete_namespaced_custom_object,
+                executor = self.leaseExecutor,
+                group = LEASE_CRD['group'], 
+                version = LEASE_CRD['version'], 
+                plural = LEASE_CRD['plural'], 
+                namespace=namespace, 
+                name = name
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
@@ -0,0 +1,117 @@
+import asyncio
+from bisect import bisect
+from collections import deque
+from datetime import datetime, timezone
+import hashlib
+import time
+import telemetry
+import utils
+
+def hash64(value:str) -> int:
+    # stable across processes (unlike hash())
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+class HashRing:
+    """ consistent hash ring of replica identities, with virtual nodes to even out the partitions """
+    def __init__(self, members, vnodes:int=64):
+        self.members = frozenset(members)
+        points = sorted((hash64(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key:str) -> str:
+        if not self._hashes:
+            return None
+        return self._owners[bisect(self._hashes, hash64(key)) % len(self._hashes)]
+
+class Membership:
+    """
+    Partitions the autoscaled Prometheus objects across operator replicas.
+
+    Every replica heartbeats its own Lease (`<leasePrefix>-<identity>`) and lists
+    the Leases of its peers; replicas whose Lease isn't renewed within
+    `leaseDuration` are dropped. Objects are assigned to live replicas with a
+    consistent hash of namespace/name, so losing or adding a replica only moves
+    its share of the objects.
+
+    To keep a single writer per Prometheus while views of the membership differ:
+      - an object gained in a rebalance is only owned once every ring seen in
+        the last `settle` seconds assigned it to this replica, giving the
+        previous owner time to see the change and let it go
+      - a replica that can't renew its own Lease within `leaseDuration` owns
+        nothing, so peers can safely take over its objects once it expires
+    """
+    def __init__(self, logger, kubeclient, identity:str, namespace:str, leasePrefix:str, labelKey:str,
+        leaseDuration:float=15,
+        renewInterval:float=5,
+        vnodes:int=64
+    ):
+        self.logger = logger
+        self.kubeclient = kubeclient
+        self.identity = identity
+        self.namespace = namespace
+        self.leaseName = f"{leasePrefix}-{identity}"
+        self.labelKey = labelKey
+        self.leaseDuration = leaseDuration
+        self.renewInterval = renewInterval
+        self.settle = 2 * renewInterval
+        self.vnodes = vnodes
+        self.ring = HashRing([], vnodes)
+        self._recentRings = deque() # (replacedAt, ring) of rings replaced within the last `settle` seconds
+        self._lastRenew = None # monotonic time of the last successful renew of our own lease
+        self._peers = {} # identity -> (renewTime, monotonic time the renewTime was first seen)
+
+    def owns(self, key:tuple) -> bool:
+        now = time.monotonic()
+        if self._lastRenew is None or now - self._lastRenew > self.leaseDuration: # fenced
+            return False
+        while self._recentRings and now - self._recentRings[0][0] > self.settle:
+            self._recentRings.popleft()
+        objectKey = '/'.join(key)
+        return self.ring.owner(objectKey) == self.identity and all(ring.owner(objectKey) == self.identity for _, ring in self._recentRings)
+
+    async def run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"failed to renew membership lease {self.namespace}/{self.leaseName}: {e}")
+            await asyncio.sleep(self.renewInterval)
+
+    async def heartbeat(self):
+        renewTime = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        await self.kubeclient.apply_lease(self.leaseName, self.namespace, {
+            'metadata': {'name': self.leaseName, 'labels': {self.labelKey: 'true'}},
+            'spec': {'holderIdentity': self.identity, 'leaseDurationSeconds': int(self.leaseDuration), 'renewTime': renewTime}
+        })
+        self._lastRenew = time.monotonic()
+        self.update(await self.kubeclient.list_leases(self.namespace, f"{self.labelKey}=true"))
+
+    def update(self, leases:list):
+        # a peer is live while its renewTime keeps changing - measured on the local clock to be immune to clock skew
+        now = time.monotonic(); peers = {}
+        for lease in leases:
+            spec = lease.get('spec', {})
+            identity = spec.get('holderIdentity'); renewTime = spec.get('renewTime')
+            if not identity or not renewTime:
+                continue
+            prev = self._peers.get(identity)
+            if prev is not None and prev[0] == renewTime:
+                peers[identity] = prev
+            elif prev is not None or utils.now() - utils.parse_timestamp(renewTime) < self.leaseDuration: # first seen: trust a recent renewTime only
+                peers[identity] = (renewTime, now)
+        self._peers = peers
+        members = {identity for identity, (_, seenAt) in peers.items() if now - seenAt <= self.leaseDuration} | {self.identity}
+
+        if members != self.ring.members:
+            self.logger.info(f"autoscaler replicas changed to {sorted(members)} - rebalancing Prometheus objects")
+            self._recentRings.append((now, self.ring))
+            self.ring = HashRing(members, self.vnodes)
+            telemetry.REPLICA_MEMBERS.set(len(members))
+
+    async def leave(self):
+        # hand over our objects immediately instead of after the lease expires
+        self._lastRenew = None
+        await self.kubeclient.delete_lease(self.leaseName, self.namespace)
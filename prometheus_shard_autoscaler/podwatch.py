@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+class PodWatcher:
+    """
+    List + watch of the Prometheus pods with a server-side label selector.
+
+    kopf applies the `labels=` filter of a handler on the client, so a kopf pod
+    handler streams and deserializes the events of every pod in the cluster.
+    This watch only receives the pods matching `labelSelector`, and keeps them
+    as plain dicts (the raw json, same keys as kopf bodies) instead of client
+    models.
+
+    Events are passed to `handler(type, pod)`: type is None for the pods of a
+    (re)list, like kopf, then ADDED, MODIFIED or DELETED. The watch resumes from
+    the last resourceVersion seen, and relists when it has expired (410 Gone).
+    The blocking stream runs in its own thread, so it never holds one of the
+    api executor threads.
+    """
+    def __init__(self, logger, kubeclient, labelSelector:str, handler, timeoutSeconds:int=300, retryInterval:float=5):
+        self.logger = logger
+        self.kubeclient = kubeclient
+        self.labelSelector = labelSelector
+        self.handler = handler # async callable(type, pod)
+        self.timeoutSeconds = timeoutSeconds
+        self.retryInterval = retryInterval
+        self._pods = {} # (namespace, name) -> last pod seen, to report the pods deleted while relisting
+
+    async def run(self):
+        while True:
+            try:
+                resourceVersion = await self.relist()
+                while resourceVersion is not None:
+                    resourceVersion = await self.watch(resourceVersion)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"prometheus pod watch failed: {e} - relisting in {self.retryInterval}s")
+                await asyncio.sleep(self.retryInterval)
+
+    async def relist(self) -> str:
+        podList = await self.kubeclient.list_pods(self.labelSelector)
+        listed = {(pod['metadata']['namespace'], pod['metadata']['name']): pod for pod in podList['items']}
+        for key in set(self._pods) - set(listed):
+            await self.dispatch('DELETED', self._pods[key])
+        for pod in listed.values():
+            await self.dispatch(None, pod)
+        return podList['metadata']['resourceVersion']
+
+    async def watch(self, resourceVersion:str) -> str:
+        # returns the resourceVersion to resume from when the watch ends - None when it expired
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        def publish(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError: # loop closed on shutdown
+                pass
+        def stream():
+            try:
+                for event in self.kubeclient.watch_pods(self.labelSelector, resourceVersion, self.timeoutSeconds):
+                    publish(event)
+                publish(None)
+            except Exception as e:
+                publish(e)
+        threading.Thread(target=stream, name='prom-pod-watch', daemon=True).start()
+
+        while True:
+            event = await queue.get()
+            if event is None:
+                return resourceVersion
+            if isinstance(event, Exception):
+                raise event
+            if event['type'] == 'ERROR':
+                if event['object'].get('code') == 410:
+                    self.logger.debug(f"prometheus pod watch expired at resourceVersion {resourceVersion} - relisting")
+                    return None
+                raise Exception(event['object'].get('message'))
+            pod = event['object']
+            resourceVersion = pod['metadata']['resourceVersion']
+            if event['type'] != 'BOOKMARK':
+                await self.dispatch(event['type'], pod)
+
+    async def dispatch(self, eventType:str, pod:dict):
+        key = (pod['metadata']['namespace'], pod['metadata']['name'])
+        if eventType == 'DELETED':
+            self._pods.pop(key, None)
+        else:
+            self._pods[key] = pod
+        try:
+            await self.handler(eventType, pod)
+        except Exception as e:
+            self.logger.error(f"exception caught handling {eventType} event of {key[1]} pod: {e}")
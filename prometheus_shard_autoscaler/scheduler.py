@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+class EvaluationScheduler:
+    """
+    Single timer loop that owns the evaluation schedule of every autoscaled Prometheus.
+
+    Evaluations are kept in a priority queue ordered by due time. New objects are
+    spread randomly across the first interval, every re-schedule is jittered so
+    evaluations never fire in lockstep, and at most `maxConcurrency` evaluations
+    are in flight at once.
+
+    An evaluation callback returns the number of seconds until it needs to run
+    again (e.g. the remaining cooldown) or None for its interval, so objects
+    in cooldown are not woken up until their cooldown ends. Objects can also be
+    woken early by events (`wake`), at most once every `minWakeSpacing` seconds
+    and never while they are held by a requested delay - unless the wake is
+    forced (e.g. an emergency), which drops the hold.
+
+    With `owns` set (e.g. when the objects are partitioned across replicas),
+    objects it rejects stay scheduled but are not evaluated.
+    """
+    def __init__(self, logger, interval:float, jitter:float=0.1, maxConcurrency:int=10, minWakeSpacing:float=1, owns=None):
+        self.logger = logger
+        self.interval = interval
+        self.jitter = jitter
+        self.maxConcurrency = maxConcurrency
+        self.minWakeSpacing = minWakeSpacing
+        self.owns = owns # callable(key) -> bool, None owns every object
+        self._intervals = {} # key -> per-object evaluation interval
+        self._holds = {} # key -> monotonic time before which wake() is ignored
+        self._lastStart = {} # key -> monotonic time the last evaluation started
+        self._rewake = set() # keys woken while their evaluation was in flight
+        self._forced = set() # keys of _rewake woken with force
+        self._heap = [] # (dueAt, seq, key) - stale items are skipped when popped
+        self._due = {} # key -> dueAt of the valid heap item
+        self._callbacks = {} # key -> async evaluation callback
+        self._running = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._semaphore = None
+
+    def register(self, key, callback, interval:float=None):
+        self._callbacks[key] = callback
+        if interval is not None:
+            self._intervals[key] = interval
+        self.schedule(key, random.uniform(0, self._intervals.get(key, self.interval))) # spread new objects across the interval
+
+    def unregister(self, key):
+        self._callbacks.pop(key, None)
+        self._due.pop(key, None)
+        self._intervals.pop(key, None)
+        self._holds.pop(key, None)
+        self._lastStart.pop(key, None)
+        self._rewake.discard(key)
+        self._forced.discard(key)
+
+    def set_interval(self, key, interval:float):
+        if key in self._callbacks:
+            self._intervals[key] = interval
+
+    def wake(self, key, force:bool=False):
+        # request an immediate evaluation (e.g. after a spec or pod change) - force drops the hold of a requested delay
+        if key not in self._callbacks:
+            return
+        now = time.monotonic()
+        if force:
+            self._holds.pop(key, None)
+        elif self._holds.get(key, 0) > now:
+            return
+        if key in self._running:
+            self._rewake.add(key)
+            if force: # the in-flight evaluation may set a new hold
+                self._forced.add(key)
+            return
+        dueAt = max(now, self._lastStart.get(key, 0) + self.minWakeSpacing)
+        if self._due.get(key, float('inf')) > dueAt:
+            self.schedule(key, dueAt - now)
+
+    def due(self, deadline:float) -> set:
+        # keys evaluated here by the monotonic deadline, in flight included - only the in-flight ones while every slot is taken
+        if len(self._running) >= self.maxConcurrency:
+            return set(self._running)
+        return set(self._running) | {key for key, dueAt in self._due.items() if dueAt <= deadline and (self.owns is None or self.owns(key))}
+
+    def stalled(self, keys:set) -> bool:
+        # every evaluation slot is held by one of keys (e.g. waiting on each other) - no other evaluation can start until they finish
+        return len(self._running) >= self.maxConcurrency and self._running <= keys
+
+    def schedule(self, key, delay:float):
+        if key not in self._callbacks:
+            return
+        dueAt = time.monotonic() + max(delay, 0)
+        self._due[key] = dueAt
+        heapq.heappush(self._heap, (dueAt, next(self._seq), key))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def next_delay(self, key, delay:float=None) -> float:
+        interval = self._intervals.get(key, self.interval)
+        if delay is None:
+            return interval * (1 + random.uniform(-self.jitter, self.jitter))
+        return delay + random.uniform(0, interval * self.jitter) # never run before a requested delay (e.g. cooldown) ends
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.maxConcurrency)
+        while True:
+            while self._heap and self._heap[0][0] <= time.monotonic():
+                dueAt, _, key = heapq.heappop(self._heap)
+                if self._due.get(key) != dueAt: # unregistered or re-scheduled
+                    continue
+                del self._due[key]
+                if key in self._running: # evaluate again once the in-flight evaluation finishes
+                    self._rewake.add(key)
+                    continue
+                if self.owns is not None and not self.owns(key): # evaluated by another replica
+                    self.schedule(key, self.next_delay(key))
+                    continue
+                await self._semaphore.acquire() # global limit on in-flight evaluations
+                self._running.add(key)
+                self._lastStart[key] = time.monotonic()
+                asyncio.ensure_future(self._evaluate(key))
+
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _evaluate(self, key):
+        delay = None
+        try:
+            callback = self._callbacks.get(key)
+            if callback is not None:
+                delay = await callback()
+        except Exception as e:
+            self.logger.error(f"unexpected exception evaluating {key}: {e}")
+        finally:
+            self._semaphore.release()
+            self._running.discard(key)
+            if delay is not None:
+                self._holds[key] = time.monotonic() + delay
+            else:
+                self._holds.pop(key, None)
+            if key not in self._due:
+                self.schedule(key, self.next_delay(key, delay))
+            if key in self._rewake:
+                self._rewake.discard(key)
+                force = key in self._forced
+                self._forced.discard(key)
+                self.wake(key, force)
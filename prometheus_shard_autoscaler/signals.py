@@ -0,0 +1,71 @@
+import asyncio
+import time
+import requests
+import telemetry
+
+HEAD_SERIES_METRIC = "prometheus_tsdb_head_series"
+SAMPLES_APPENDED_METRIC = "prometheus_tsdb_head_samples_appended_total"
+
+def parse_metrics_text(text:str, names:tuple) -> dict:
+    # sum the samples of the given metric names in prometheus text exposition format
+    values = {}
+    for line in text.splitlines():
+        if not line or line[0] == '#' or not line.startswith(names):
+            continue
+        labelsEnd = line.rfind('}')
+        if labelsEnd != -1:
+            name = line[:line.index('{')]
+            rest = line[labelsEnd+1:].split()
+        else:
+            name, *rest = line.split()
+        if name in names and rest:
+            values[name] = values.get(name, 0.0) + float(rest[0])
+    return values
+
+class ShardMetricsScraper:
+    """
+    Scrapes the /metrics endpoint of every pod of a single Prometheus for the
+    head series count and the ingestion rate (derived from the samples appended
+    counter between two scrapes of the same pod).
+    """
+    def __init__(self, logger, listPods, executor=None, port:int=9090, routePrefix:str='/', timeout:float=5):
+        self.logger = logger
+        self.listPods = listPods # callable returning [(podName, podIP)]
+        self.executor = executor
+        self.port = port
+        self.routePrefix = routePrefix
+        self.timeout = timeout
+        self._counters = {} # pod name -> (time, samples appended)
+
+    def fetch(self, podIP:str) -> dict:
+        start = time.monotonic()
+        try:
+            res = requests.get(f"http://{podIP}:{self.port}{self.routePrefix.rstrip('/')}/metrics", timeout=self.timeout)
+            res.raise_for_status()
+            return parse_metrics_text(res.text, (HEAD_SERIES_METRIC, SAMPLES_APPENDED_METRIC))
+        finally:
+            telemetry.SHARD_SCRAPE_LATENCY.observe(time.monotonic() - start)
+
+    async def scrape(self) -> list:
+        # returns [{'head-series': float, 'samples-rate': float or None}] for each pod that could be scraped
+        loop = asyncio.get_running_loop()
+        pods = [(podName, podIP) for podName, podIP in self.listPods() if podIP]
+        results = await asyncio.gather(
+            *[loop.run_in_executor(self.executor, self.fetch, podIP) for _, podIP in pods],
+            return_exceptions=True
+        )
+
+        now = time.time(); podMetrics = []; counters = {}
+        for (podName, _), result in zip(pods, results):
+            if isinstance(result, Exception):
+                self.logger.warning(f"failed scraping metrics from pod {podName}: {result}")
+                continue
+            samplesRate = None
+            if SAMPLES_APPENDED_METRIC in result:
+                counters[podName] = (now, result[SAMPLES_APPENDED_METRIC])
+                prev = self._counters.get(podName)
+                if prev is not None and now > prev[0] and result[SAMPLES_APPENDED_METRIC] >= prev[1]: # skip counter resets
+                    samplesRate = (result[SAMPLES_APPENDED_METRIC] - prev[1]) / (now - prev[0])
+            podMetrics.append({'head-series': result.get(HEAD_SERIES_METRIC), 'samples-rate': samplesRate})
+        self._counters = counters
+        return podMetrics
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Offline simulator for prometheus shard autoscaling policies.
+
+Replays a recorded time series of prometheus pod usage through the same
+evaluation used by the operator (new_evaluation -> cooldown + scale_sequence ->
+calculate_desired_shards) with a virtual clock, and reports the number of
+reshards, the time spent over target memory util and the shard-hours used.
+
+The recorded usage is converted to total usage across shards (average pod
+usage * recorded shards) and split evenly across the simulated shards.
+
+Inputs:
+  - CSV with columns: timestamp,pod,cpu,memory,shards (timestamp in epoch
+    seconds or RFC3339, cpu/memory as kubernetes quantities)
+  - JSON lines recorded by the operator's pod metrics cache
+    (PROM_AUTOSCALER_METRICS_RECORD_FILE)
+
+Example:
+  python prometheus_shard_autoscaler/simulator.py --input usage.csv --shards 2 --memory-request 5Gi \\
+      --annotation min-cooldown=900 --grid desired-shards-algorithm=hpa,double-or-decrement
+"""
+import argparse
+import asyncio
+from bisect import bisect_right
+import csv
+import itertools
+import json
+import logging
+import time
+
+# local imports
+import app
+import kube
+from kube import KubeClient, PROM_OPERATOR_LABEL_PREFIX
+import utils
+
+class UsageSeries:
+    def __init__(self, points:list):
+        # points: [(timestamp, totalCpu, totalMemory)] - usage summed across the shards of one replica
+        self.points = sorted(points)
+        self.timestamps = [p[0] for p in self.points]
+
+    def __len__(self):
+        return len(self.points)
+
+    def at(self, timestamp:float) -> tuple:
+        # latest point at or before timestamp (first point before the series starts)
+        i = max(bisect_right(self.timestamps, timestamp) - 1, 0)
+        return self.points[i]
+
+    @classmethod
+    def from_pod_samples(cls, samples:dict):
+        # samples: {timestamp: ([(cpu, memory)], recordedShards)}
+        points = []
+        for timestamp, (pods, shards) in samples.items():
+            if pods:
+                points.append((
+                    timestamp,
+                    sum(cpu for cpu, _ in pods) / len(pods) * shards,
+                    sum(memory for _, memory in pods) / len(pods) * shards
+                ))
+        return cls(points)
+
+    @classmethod
+    def load_csv(cls, path:str):
+        samples = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                timestamp = row['timestamp']
+                timestamp = float(timestamp) if timestamp.replace('.', '', 1).isdigit() else utils.parse_timestamp(timestamp)
+                pods, _ = samples.setdefault(timestamp, ([], int(row.get('shards') or 1)))
+                pods.append((float(utils.parse_quantity(row['cpu'])), float(utils.parse_quantity(row['memory']))))
+        return cls.from_pod_samples(samples)
+
+    @classmethod
+    def load_metrics_record(cls, path:str, name:str, namespace:str=None):
+        samples = {}
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                pods = []; shards = set()
+                for pod in record['items']:
+                    metadata = pod['metadata']
+                    labels = metadata.get('labels', {})
+                    if labels.get(f"{PROM_OPERATOR_LABEL_PREFIX}/name") != name or (namespace and metadata['namespace'] != namespace):
+                        continue
+                    shards.add(labels.get(f"{PROM_OPERATOR_LABEL_PREFIX}/shard", '0'))
+                    cpu = sum(utils.parse_quantity(c['usage']['cpu']) for c in pod['containers'])
+                    memory = sum(utils.parse_quantity(c['usage']['memory']) for c in pod['containers'])
+                    if cpu != 0 and memory != 0:
+                        pods.append((float(cpu), float(memory)))
+                samples[record['time']] = (pods, max(len(shards), 1))
+        return cls.from_pod_samples(samples)
+
+class ReplayApi:
+    """ stand-in for CustomObjectsApi serving pod metrics from a UsageSeries and applying patches in memory """
+    def __init__(self, series:UsageSeries, name:str, namespace:str, spec:dict, annotations:dict, replicas:int=1):
+        self.series = series
+        self.name = name
+        self.namespace = namespace
+        self.spec = spec
+        self.annotations = annotations
+        self.replicas = replicas
+        self.reshards = []
+        self.resizes = [] # memory request changes (algorithm 'joint')
+
+    def list_namespaced_custom_object(self, **kwargs) -> dict:
+        timestamp, totalCpu, totalMemory = self.series.at(utils.now())
+        shards = self.spec['shards']
+        sampleTime = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+        usage = {'cpu': f"{int(totalCpu / shards * 1e9)}n", 'memory': str(int(totalMemory / shards))}
+        items = []
+        for shard in range(shards):
+            for replica in range(self.replicas):
+                podName = f"prometheus-{self.name}-{replica}" if shard == 0 else f"prometheus-{self.name}-shard-{shard}-{replica}"
+                items.append({
+                    'metadata': {
+                        'name': podName,
+                        'namespace': self.namespace,
+                        'labels': {
+                            f"{PROM_OPERATOR_LABEL_PREFIX}/name": self.name,
+                            f"{PROM_OPERATOR_LABEL_PREFIX}/shard": str(shard)
+                        }
+                    },
+                    'timestamp': sampleTime,
+                    'window': '30s',
+                    'containers': [{'name': 'prometheus', 'usage': usage}]
+                })
+        return {'items': items}
+
+    list_cluster_custom_object = list_namespaced_custom_object
+
+    def patch_namespaced_custom_object(self, body:dict, **kwargs):
+        if 'shards' in body.get('spec', {}) and body['spec']['shards'] != self.spec['shards']:
+            self.reshards.append((utils.now(), self.spec['shards'], body['spec']['shards']))
+        memoryRequest = body.get('spec', {}).get('resources', {}).get('requests', {}).get('memory')
+        if memoryRequest is not None and memoryRequest != self.spec['resources']['requests']['memory']:
+            self.resizes.append((utils.now(), self.spec['resources']['requests']['memory'], memoryRequest))
+        patchSpec = dict(body.get('spec', {}))
+        for field, value in patchSpec.pop('resources', {}).items(): # merge patch - only the patched resources change
+            self.spec.setdefault('resources', {}).setdefault(field, {}).update(value)
+        self.spec.update(patchSpec)
+        self.annotations.update(body.get('metadata', {}).get('annotations', {}))
+        return {}
+
+class ReplayKubeClient(KubeClient):
+    """ KubeClient running the real decision logic against a ReplayApi """
+    def __init__(self, logger, api:ReplayApi):
+        self.clientCustomObjectsApi = api
+        self.metricsCache = None
+        self.executor = None
+        self.requestTimeout = None
+        self.connectTimeout = None
+        self.metricsMaxAge = float('inf') # gaps in a recording are replayed with the last sample
+        self.dryRun = False
+        self._podUsage = {}
+        kube.LOGGER = logger
+
+    async def call_api(self, apiCall:str, method, executor = None, **kwargs):
+        return method(**kwargs)
+
+async def simulate_async(series:UsageSeries, annotations:dict, shards:int, memoryRequest:str,
+        cpuRequest:str=None, replicas:int=1, name:str='prom', namespace:str='monitoring', logger=None
+    ) -> dict:
+    logger = logger or logging.getLogger('simulator')
+    app.LOGGER = logger
+
+    resources = {'requests': {'memory': memoryRequest}}
+    if cpuRequest:
+        resources['requests']['cpu'] = cpuRequest
+    spec = {'shards': shards, 'resources': resources}
+    annotations = {f"{app.PROM_AUTOSCALER_KEY_PREFIX}/{key}": str(value) for key, value in annotations.items()}
+    resolver = app.new_config_resolver(name)
+    configs = resolver.resolve(annotations)
+
+    api = ReplayApi(series, name, namespace, spec, annotations, replicas)
+    kubeclient = ReplayKubeClient(logger, api)
+    start, end = series.timestamps[0], series.timestamps[-1]
+    clock = [start]
+    prevClock = utils.CLOCK
+    utils.set_clock(lambda: clock[0])
+    try:
+        evaluate = app.new_evaluation(kubeclient, name, namespace, spec, annotations, resolver=resolver)
+        interval = configs.evaluation_interval
+        evaluations = 0; nextEvaluation = start; shardSeconds = 0.0; reservedByteSeconds = 0.0; secondsOverTarget = 0.0; secondsOverRequest = 0.0; maxShards = shards
+        while clock[0] <= end:
+            if clock[0] >= nextEvaluation:
+                delay = await evaluate()
+                evaluations += 1
+                nextEvaluation = clock[0] + (delay if delay is not None else interval)
+
+            _, _, totalMemory = series.at(clock[0])
+            memPerShard = totalMemory / spec['shards']
+            memRequest = utils.parse_bytes(spec['resources']['requests']['memory']) # changed by algorithm 'joint'
+            memTarget = memRequest * float(configs.target_memory_util)
+            shardSeconds += spec['shards'] * interval
+            reservedByteSeconds += spec['shards'] * replicas * memRequest * interval
+            secondsOverTarget += interval if memPerShard > memTarget else 0
+            secondsOverRequest += interval if memPerShard > memRequest else 0
+            maxShards = max(maxShards, spec['shards'])
+            clock[0] += interval
+    finally:
+        utils.set_clock(prevClock)
+
+    return {
+        'simulated_hours': round((end - start) / 3600, 2),
+        'evaluations': evaluations,
+        'reshards': len(api.reshards),
+        'resizes': len(api.resizes),
+        'final_shards': spec['shards'],
+        'max_shards': maxShards,
+        'shard_hours': round(shardSeconds / 3600, 2),
+        'reserved_memory_gib_hours': round(reservedByteSeconds / 2**30 / 3600, 2),
+        'final_memory_request': spec['resources']['requests']['memory'],
+        'hours_over_target_util': round(secondsOverTarget / 3600, 2),
+        'hours_over_request': round(secondsOverRequest / 3600, 2)
+    }
+
+def simulate(series:UsageSeries, annotations:dict, shards:int, memoryRequest:str, **kwargs) -> dict:
+    return asyncio.run(simulate_async(series, annotations, shards, memoryRequest, **kwargs))
+
+def grid(annotations:dict, gridValues:dict) -> list:
+    # cartesian product of the grid values merged over the base annotations
+    keys = list(gridValues.keys())
+    return [{**annotations, **dict(zip(keys, values))} for values in itertools.product(*[gridValues[k] for k in keys])]
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded prometheus usage through the shard autoscaler")
+    parser.add_argument('--input', required=True, help="CSV (timestamp,pod,cpu,memory,shards) or JSON lines recorded by the pod metrics cache")
+    parser.add_argument('--name', default='prom', help="prometheus name to replay from a metrics cache record")
+    parser.add_argument('--namespace', default=None, help="prometheus namespace to replay from a metrics cache record")
+    parser.add_argument('--shards', type=int, default=1, help="initial shards")
+    parser.add_argument('--replicas', type=int, default=1, help="replicas per shard")
+    parser.add_argument('--memory-request', required=True, help="spec.resources.requests.memory (e.g. 5Gi)")
+    parser.add_argument('--cpu-request', default=None, help="spec.resources.requests.cpu (e.g. 500m)")
+    parser.add_argument('--annotation', action='append', default=[], help="autoscaling annotation without prefix, e.g. min-cooldown=900")
+    parser.add_argument('--grid', action='append', default=[], help="annotation values to grid-search, e.g. max-increment=0,1,2")
+    parser.add_argument('--json', action='store_true', help="print one JSON report per line")
+    parser.add_argument('--verbose', action='store_true', help="log every evaluation")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+    if args.input.endswith('.csv'):
+        series = UsageSeries.load_csv(args.input)
+    else:
+        series = UsageSeries.load_metrics_record(args.input, args.name, args.namespace)
+    if not len(series):
+        raise Exception(f"no usage samples found in {args.input}")
+
+    annotations = dict(a.split('=', 1) for a in args.annotation)
+    gridValues = {key: values.split(',') for key, values in (g.split('=', 1) for g in args.grid)}
+    for runAnnotations in grid(annotations, gridValues):
+        start = time.monotonic()
+        report = simulate(series, runAnnotations, args.shards, args.memory_request,
+            cpuRequest=args.cpu_request, replicas=args.replicas, name=args.name, namespace=args.namespace or 'monitoring'
+        )
+        report['wall_seconds'] = round(time.monotonic() - start, 2)
+        params = {key: runAnnotations[key] for key in gridValues}
+        if args.json:
+            print(json.dumps({'params': params, **report}))
+        else:
+            print(' '.join(f"{k}={v}" for k, v in {**params, **report}.items()))
+
+if __name__ == '__main__':
+    main()
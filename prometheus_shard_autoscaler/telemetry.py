@@ -0,0 +1,92 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+METRIC_PREFIX = "prom_shard_autoscaler"
+OBJECT_LABELS = ['namespace', 'name'] # the autoscaled Prometheus
+
+# HOT-PATH TIMINGS
+API_CALL_LATENCY = Histogram(
+    f"{METRIC_PREFIX}_api_call_duration_seconds",
+    "latency of kubernetes api calls made by the autoscaler (including time queued for an executor thread)",
+    ['call'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+SHARD_SCRAPE_LATENCY = Histogram(
+    f"{METRIC_PREFIX}_shard_scrape_duration_seconds",
+    "latency of scraping the /metrics endpoint of a prometheus shard pod",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+EVALUATION_PHASE_LATENCY = Histogram(
+    f"{METRIC_PREFIX}_evaluation_phase_duration_seconds",
+    "latency of the phases of an evaluation: fetch (pod metrics, cache hits included), calculate (desired shards, fetch included), patch and evaluation (end to end)",
+    ['phase'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+# COUNTERS
+API_CALLS = Counter(
+    f"{METRIC_PREFIX}_api_calls",
+    "kubernetes api calls made by the autoscaler",
+    ['call', 'outcome']
+)
+
+EVALUATION_ERRORS = Counter(
+    f"{METRIC_PREFIX}_evaluation_errors",
+    "evaluations of a Prometheus that raised an exception",
+    OBJECT_LABELS
+)
+
+SCALE_EVENTS = Counter(
+    f"{METRIC_PREFIX}_scale_events",
+    "shard patches executed for a Prometheus",
+    OBJECT_LABELS + ['direction']
+)
+
+EMERGENCY_SCALE_UPS = Counter(
+    f"{METRIC_PREFIX}_emergency_scale_ups",
+    "emergency scale-ups of a Prometheus triggered by a pod terminated out of memory, by reason: oomkilled or crashloop",
+    OBJECT_LABELS + ['reason']
+)
+
+EXCLUDED_PODS = Counter(
+    f"{METRIC_PREFIX}_excluded_pods",
+    "pods excluded from the usage of a Prometheus by reason: pending (zero usage), stale (old metrics sample) or missing (no metrics)",
+    OBJECT_LABELS + ['reason']
+)
+
+BUDGET_LIMITED_SCALES = Counter(
+    f"{METRIC_PREFIX}_budget_limited_scales",
+    "scales of a Prometheus limited by the fleet budget, by outcome: trimmed (fewer shards granted) or deferred (nothing granted)",
+    OBJECT_LABELS + ['outcome']
+)
+
+# PER-OBJECT STATE
+CURRENT_SHARDS = Gauge(f"{METRIC_PREFIX}_current_shards", "spec.shards of a Prometheus", OBJECT_LABELS)
+DESIRED_SHARDS = Gauge(f"{METRIC_PREFIX}_desired_shards", "desired shards calculated in the last evaluation of a Prometheus", OBJECT_LABELS)
+MEMORY_UTIL = Gauge(f"{METRIC_PREFIX}_memory_utilization", "observed memory usage (per current-usage-calculator) relative to the memory request", OBJECT_LABELS)
+WARMUP_SECONDS = Gauge(f"{METRIC_PREFIX}_warmup_seconds", "time desired shards has differed from current shards (0 when not warming up)", OBJECT_LABELS)
+SHARD_SKEW = Gauge(f"{METRIC_PREFIX}_shard_skew", "memory usage of the busiest shard relative to the median shard (replicas collapsed to the busiest)", OBJECT_LABELS)
+COOLDOWN_REMAINING_SECONDS = Gauge(f"{METRIC_PREFIX}_cooldown_remaining_seconds", "time remaining in the cooldown since the last scale event", OBJECT_LABELS)
+
+REPLICA_MEMBERS = Gauge(f"{METRIC_PREFIX}_replica_members", "live autoscaler replicas the Prometheus objects are partitioned across")
+BUDGET_USED = Gauge(f"{METRIC_PREFIX}_budget_used", "shards or requested memory bytes (by resource) of the autoscaled Prometheus objects in a budget pool (namespace, '' for the cluster) as of the last allocation round", ['pool', 'resource'])
+
+OBJECT_METRICS = (EVALUATION_ERRORS, CURRENT_SHARDS, DESIRED_SHARDS, MEMORY_UTIL, SHARD_SKEW, WARMUP_SECONDS, COOLDOWN_REMAINING_SECONDS)
+
+def start(port:int):
+    start_http_server(port)
+
+def forget(namespace:str, name:str):
+    # drop the series of a Prometheus that is no longer autoscaled
+    for metric in OBJECT_METRICS:
+        try:
+            metric.remove(namespace, name)
+        except KeyError:
+            pass
+    for metric, labelValues in ((SCALE_EVENTS, ('up', 'down')), (EXCLUDED_PODS, ('pending', 'stale', 'missing')), (EMERGENCY_SCALE_UPS, ('oomkilled', 'crashloop')), (BUDGET_LIMITED_SCALES, ('trimmed', 'deferred'))):
+        for labelValue in labelValues:
+            try:
+                metric.remove(namespace, name, labelValue)
+            except KeyError:
+                pass
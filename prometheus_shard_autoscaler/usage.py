@@ -0,0 +1,92 @@
+from decimal import Decimal
+import utils
+
+class PodUsage:
+    """
+    Usage of the pods of a single Prometheus, aggregated in one pass over a
+    metrics.k8s.io pods list: count, sum, max and min of cpu (nanocores) and
+    memory (bytes) over the pods with a usable sample.
+
+    Pods are also grouped by shard (`shardLabel`), collapsing the replicas of a
+    shard to its busiest replica, so a single hot shard can be told apart from
+    load spread across all shards.
+
+    Pods are excluded (and counted) when they are:
+      - pending: reporting zero cpu or memory (e.g. still scheduling/starting)
+      - stale: their sample is older than `maxAge` seconds
+      - missing: expected (shards * replicas) but absent from the list
+    """
+    def __init__(self):
+        self.count = 0
+        self.sumCpu = 0; self.sumMemory = 0
+        self.maxCpu = 0; self.maxMemory = 0
+        self.minCpu = None; self.minMemory = None
+        self.pending = 0
+        self.stale = 0
+        self.missing = 0
+        self.samples = [] # (pod name, timestamp, cpu cores, memory bytes) of the usable pods
+        self.shards = {} # shard -> [cpu, memory] of its busiest replica
+
+    @classmethod
+    def aggregate(cls, podMetrics:list, now:float, maxAge:float, expectedPods:int=None, shardLabel:str=None):
+        usage = cls()
+        for pod in podMetrics:
+            cpu = 0; memory = 0
+            for container in pod['containers']:
+                containerUsage = container['usage']
+                cpu += utils.parse_nanocores(containerUsage['cpu'])
+                memory += utils.parse_bytes(containerUsage['memory'])
+            timestamp = utils.parse_timestamp(pod['timestamp'])
+            if cpu == 0 or memory == 0:
+                usage.pending += 1
+                continue
+            if now - timestamp > maxAge:
+                usage.stale += 1
+                continue
+            usage.count += 1
+            usage.sumCpu += cpu; usage.sumMemory += memory
+            if cpu > usage.maxCpu: usage.maxCpu = cpu
+            if memory > usage.maxMemory: usage.maxMemory = memory
+            if usage.minCpu is None or cpu < usage.minCpu: usage.minCpu = cpu
+            if usage.minMemory is None or memory < usage.minMemory: usage.minMemory = memory
+            usage.samples.append((pod['metadata']['name'], timestamp, cpu / utils.NANOCORES, memory))
+            shard = pod['metadata'].get('labels', {}).get(shardLabel, pod['metadata']['name']) # unlabelled pods are their own shard
+            shardUsage = usage.shards.get(shard)
+            if shardUsage is None:
+                usage.shards[shard] = [cpu, memory]
+            else:
+                if cpu > shardUsage[0]: shardUsage[0] = cpu
+                if memory > shardUsage[1]: shardUsage[1] = memory
+        if expectedPods is not None:
+            usage.missing = max(expectedPods - len(podMetrics), 0)
+        return usage
+
+    def avg(self) -> dict:
+        # integer sums converted to Decimal once
+        if not self.count:
+            return {'cpu': 0, 'memory': 0}
+        return {'cpu': Decimal(self.sumCpu) / utils.NANOCORES / self.count, 'memory': Decimal(self.sumMemory) / self.count}
+
+    def max(self) -> dict:
+        return {'cpu': Decimal(self.maxCpu) / utils.NANOCORES, 'memory': Decimal(self.maxMemory)}
+
+    def min(self) -> dict:
+        if not self.count:
+            return {'cpu': 0, 'memory': 0}
+        return {'cpu': Decimal(self.minCpu) / utils.NANOCORES, 'memory': Decimal(self.minMemory)}
+
+    def median(self) -> dict:
+        # usage of the median shard - not moved by a single hot shard
+        if not self.shards:
+            return {'cpu': 0, 'memory': 0}
+        return {
+            'cpu': utils.median(sorted(cpu for cpu, _ in self.shards.values())) / utils.NANOCORES,
+            'memory': utils.median(sorted(memory for _, memory in self.shards.values()))
+        }
+
+    def skew(self) -> Decimal:
+        # memory of the busiest shard relative to the median shard (1 when the shards are balanced)
+        if not self.shards:
+            return Decimal(1)
+        memories = sorted(memory for _, memory in self.shards.values())
+        return memories[-1] / utils.median(memories)
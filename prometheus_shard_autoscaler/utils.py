@@ -1,7 +1,18 @@
 # extracted from: https://github.com/kubernetes-client/python/blob/2f34a1ce9491cf9332f581b2207b72f0d0ab8f78/kubernetes/utils/quantity.py
-import asyncio
-from decimal import Decimal, InvalidOperation
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation, localcontext
+from functools import lru_cache
 from math import ceil
+import time
+
+CLOCK = time.time # wall clock used for scaling decisions - replaced by a virtual clock in the simulator
+
+def now() -> float:
+    return CLOCK()
+
+def set_clock(clock):
+    global CLOCK
+    CLOCK = clock
 
 def stringToBool(boolString:str) -> bool:
     boolString = boolString.strip().upper()
@@ -12,23 +23,19 @@ def stringToBool(boolString:str) -> bool:
     else:
         raise Exception(f"boolString must be either TRUE or FALSE but is {boolString}.")
 
-def sizeof_fmt(num:Decimal, suffix="B"):
+def sizeof_fmt(num, suffix="B"):
+    num = float(num) # only used for log formatting - float is precise enough
     for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
-        if abs(num) < Decimal(1024.0):
+        if abs(num) < 1024.0:
             return f"{num:3.1f} {unit}{suffix}"
-        num /= Decimal(1024.0)
+        num /= 1024.0
     return f"{num:.1f} Yi{suffix}"
 
-async def sleep_and_log(waitTime:int, logger):
-    interval = 5 # 5 second intervals
-
-    loops = ceil(waitTime / 5) 
-    waitTime = loops * interval 
-
-    logger.info(f"waiting total of {waitTime} seconds")
-    for i in range(loops):
-        await asyncio.sleep(interval)
-        logger.info(f"waited {str(interval * (i+1))} out of {waitTime}s")
+@lru_cache(maxsize=1024) # the pods of a metrics list share a few distinct timestamps
+def parse_timestamp(timestamp:str) -> float:
+    # RFC3339 timestamps as returned by the kubernetes api (e.g. 2022-11-03T20:15:04Z)
+    parsed = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
 
 def parse_quantity(quantity) -> Decimal:
     """
@@ -84,4 +91,49 @@ def parse_quantity(quantity) -> Decimal:
         raise ValueError("{} has unknown suffix".format(quantity))
 
     exponent = Decimal(exponents[suffix[0]])
-    return number * (base ** exponent)
\ No newline at end of file
+    return number * (base ** exponent)
+
+# FAST PATH: integer quantities for the evaluation hot path (pod metrics are parsed for every container on every evaluation)
+NANOCORES = 10**9 # cpu unit of parse_nanocores (metrics-server reports cpu usage in nanocores)
+_EXPONENTS = {"n": -3, "u": -2, "m": -1, "K": 1, "k": 1, "M": 2, "G": 3, "T": 4, "P": 5, "E": 6}
+_SUFFIX_FACTORS = {"": (1, 1)} # suffix -> (numerator, denominator) of its multiplier - same suffixes as parse_quantity
+for _suffix, _exponent in _EXPONENTS.items():
+    _SUFFIX_FACTORS[_suffix] = (1000**_exponent, 1) if _exponent > 0 else (1, 1000**-_exponent)
+    if _suffix != "k": # handle SI inconsistency
+        _SUFFIX_FACTORS[_suffix + "i"] = (1024**_exponent, 1) if _exponent > 0 else (1, 1024**-_exponent)
+
+@lru_cache(maxsize=4096)
+def parse_quantity_int(quantity, unit:int=1) -> int:
+    """
+    Parse kubernetes canonical form quantity to an integer number of 1/unit,
+    rounded up like kubernetes does (e.g. unit=1 for bytes, unit=NANOCORES for
+    nanocores). Same as ceil(parse_quantity(quantity) * unit), but plain digits
+    with a suffix are parsed without Decimal and repeated strings are memoized.
+    Raises:
+    ValueError on invalid or unknown input
+    """
+    if isinstance(quantity, str):
+        suffix = ""
+        if quantity[-1:] == "i":
+            suffix = quantity[-2:]
+        elif quantity[-1:] in _EXPONENTS:
+            suffix = quantity[-1:]
+        number = quantity[:len(quantity) - len(suffix)]
+        if suffix in _SUFFIX_FACTORS and number.isdigit() and number.isascii():
+            numerator, denominator = _SUFFIX_FACTORS[suffix]
+            return -(-int(number) * numerator * unit // denominator) # ceil division
+    with localcontext() as ctx: # fractions, exponents, signs and errors - exact like the integer path
+        ctx.prec = 64
+        return ceil(parse_quantity(quantity) * unit)
+
+def parse_bytes(quantity) -> int:
+    return parse_quantity_int(quantity, 1)
+
+def parse_nanocores(quantity) -> int:
+    return parse_quantity_int(quantity, NANOCORES)
+
+def median(sortedValues:list) -> Decimal:
+    middle = len(sortedValues) // 2
+    if len(sortedValues) % 2:
+        return Decimal(sortedValues[middle])
+    return (Decimal(sortedValues[middle - 1]) + Decimal(sortedValues[middle])) / 2